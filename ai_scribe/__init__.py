@@ -86,6 +86,27 @@ _NAME_ALIASES = {
     "Solider2": "Solider (Terra Flashback)",
 }
 
+class Deferred:
+    """
+    Text which is only rendered, as `func(*args, **kwargs)`, once it is converted to a string. For the
+    renderings of graphs and scripts that are expensive and usually not needed, like debug log messages:
+
+        log.debug("%s", Deferred(cmd_graph.to_text_repr, suppress_args=False))
+
+    The text is kept after the first rendering, so a shared instance is rendered at most once.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self._render = (func, args, kwargs)
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            func, args, kwargs = self._render
+            self._text = str(func(*args, **kwargs))
+            # Let go of whatever was needed to render it
+            self._render = None
+        return self._text
+
 def tableau_scripts(s1, s2):
     s1 = s1.replace("\t", "  ").split("\n")
     s2 = s2.replace("\t", "  ").split("\n")
@@ -101,7 +122,8 @@ def tableau_scripts(s1, s2):
 def verify_rom(outfname, export, names, main_block_start=0xF8700):
     from .extract import extract
 
-    new_scripts, new_names, _ = extract(outfname, return_names=True)
+    # Every output ROM is new, so there's no sense in caching it
+    new_scripts, new_names, _ = extract(outfname, return_names=True, use_cache=False)
     for n, scr in new_scripts.items():
         same = scr._bytes == export[n]._bytes
         name = names[n]
@@ -119,7 +141,7 @@ def verify_rom(outfname, export, names, main_block_start=0xF8700):
         elif close:
             log.debug(f"BUFFERED: {n} ({name})")
             log.debug(f"{hex(scr.ptr)} <-> {hex(export[n].ptr or 0)}")
-            log.debug(tableau_scripts(scr.translate(), export[n].translate()))
+            log.debug("%s", Deferred(lambda: tableau_scripts(scr.translate(), export[n].translate())))
             continue
         elif not same:
             # print(n, scr._bytes, export[n]._bytes)
@@ -1,5 +1,6 @@
 import os
 import glob
+import json
 import math
 import random
 import numpy
@@ -10,15 +11,19 @@ logging.basicConfig()
 from . import extract
 from . import pack
 from . import scripting
+from . import syntax
 from . import command_graph
 from . import themes
+from . import timing
 
 from . import _NAME_ALIASES, _BOSS_DIFFICULTY_SCALING, _MIN_BOSS_DIFFICULTY
-from . import tableau_scripts, verify_rom
+from . import Deferred, tableau_scripts, verify_rom
 
 from .data import apply_esper_target_patch, give_base_mp, generate_skill_tiers
 from .data import _ESPER_TARGET_PATCH_LEN
 from .flags import ESPERS, DESPERATIONS
+from .rom import RomImage, RomBuffer
+from .spoiler import SpoilerMeta
 from .themes import AREA_SETS, BOSSES, EVENT_BATTLES, SCRIPT_MANAGERS, SNGL_CMDS
 
 # We have to do this here or else the submodules will override it.
@@ -156,45 +161,72 @@ if __name__ == "__main__":
 
         # Should we reload the written ROM and verify it?
         "verify_rom": True,
+        # Keep parsed scripts from input ROMs on disk, so that
+        # the same ROM does not need to be parsed again
+        "cache_extraction": True,
+        # Storage for the command transitions while generating
+        # "dense" is a precomputed transition matrix and is much faster to sample from,
+        # "networkx" is the original graph representation
+        "graph_backend": "dense",
+        # Write generation counters (aborts, rejected tokens, attempts) per area next to the spoiler
+        "generation_metrics": True,
+        # Write the wall time of every phase of a run as JSON lines next to the spoiler
+        "timing_report": True,
+        # and print a summary table of them at the end of the batch
+        "timing_summary": False,
     }
 
     random.seed(conf.get("random_seed", 0))
     numpy.random.seed(conf.get("random_seed", 0))
+    command_graph.RNG_POOL.seed(conf.get("random_seed", 0))
 
     skill_tiers = generate_skill_tiers()
 
+    # phase timings of the whole batch
+    timings = []
+
     # batching
     for i in range(conf["copies_per_batch"]):
-        # carry some additional metadata around
-        _meta = {}
+        timer = timing.PhaseTimer(seed=conf.get("random_seed", 0), copy=i)
+        # carry some additional metadata around, for the spoiler
+        _meta = SpoilerMeta()
+        # generation counters, by area
+        _metrics = {}
 
         fname = numpy.random.choice(fnames)
         log.debug(f"Reading {fname}")
-        with open(fname, "rb") as fin:
-            romfile = fin.read()
-        log.debug(f"Read {fname}: {len(romfile)} bytes")
+        # The file is mapped once and shared by all of the extraction steps
+        with RomImage(fname) as rom:
+            with timer("load_rom"):
+                # Working copy of the ROM, all modifications are made in place
+                romfile = RomBuffer(rom)
+            log.debug(f"Read {fname}: {len(romfile)} bytes")
+
+            with timer("extract"):
+                scripts = extract.ScriptSet(rom, use_cache=conf["cache_extraction"])
+        names, blocks = scripts.canonical_names, scripts.script_blocks
+        log.info(f"Read {len(scripts.scripts)} total scripts from {fname} in {len(blocks)} blocks")
 
         if conf["give_min_mp"]:
             log.info("Giving minimum MP to all enemies.")
-            romfile = give_base_mp(romfile)
+            with timer("give_base_mp"):
+                romfile = give_base_mp(romfile)
         if not conf["esper_party_targeting"]:
             # remove them from the pool, because they won't work
             conf["drop_skills"] |= set(ESPERS)
 
-        scripts, names, blocks = extract.extract(fname, return_names=True)
-        log.info(f"Read {len(scripts)} total scripts from {fname} in {len(blocks)} blocks")
-
-        scripts = extract.ScriptSet(fname)
-
-        full_graph = command_graph.CommandGraph()
-        full_graph.from_scripts({k: v._bytes for k, v in scripts.scripts.items()})
+        with timer("full_graph"):
+            full_graph = command_graph.CommandGraph()
+            full_graph.from_scripts(scripts.scripts)
+        # Consecutive area windows share most of their scripts, so count every script once
+        pool_counts = command_graph.PoolCounts()
 
         #batt_msgs = extract.extract_battle_msgs(srcrom)
 
         # tracks the marginal budget we have on free space
         extra_space = 0
         script_length_orig = sum(map(len, scripts.scripts.values()))
-        log.debug((hex(script_length_orig), hex(0xFC050 - 0xF8700)))
+        log.debug("%s", (hex(script_length_orig), hex(0xFC050 - 0xF8700)))
 
         scr, ptrs = [], []
         mod_scripts = {}
@@ -222,107 +254,110 @@ if __name__ == "__main__":
             pool = {n: scripts[n] for n in pool}
             log.debug(f"Formed pool of {len(pool)} scripts to use this iteration.")
 
-            cmd_graph = command_graph.CommandGraph()
-            cmd_graph.from_scripts({k: v._bytes for k, v in pool.items()})
+            with timer("pool_graph", set_idx=set_idx):
+                cmd_graph = pool_counts.graph(pool, backend=conf["graph_backend"])
 
-            # Allow for random messages
-            if conf["talkative"]:
-                cmd_graph.cmd_arg_graphs[0xF3] = full_graph.cmd_arg_graphs[0xF3]
+                # Allow for random messages
+                if conf["talkative"]:
+                    cmd_graph.cmd_arg_graphs[0xF3] = full_graph.cmd_arg_graphs[0xF3]
 
-            # add a little spice
-            command_graph.augment_cmd_graph(cmd_graph, status=conf["spice"]["boss_status"],
-                                                       elemental=conf["spice"]["boss_elemental"],
-                                                       command=conf["spice"]["boss_command"])
-            command_graph.edit_cmd_arg_graph(cmd_graph, drop_skills=conf["drop_skills"],
-                                                        add_cmds=conf["spice"]["allowed_commands"])
+                # add a little spice
+                command_graph.augment_cmd_graph(cmd_graph, status=conf["spice"]["boss_status"],
+                                                           elemental=conf["spice"]["boss_elemental"],
+                                                           command=conf["spice"]["boss_command"])
+                command_graph.edit_cmd_arg_graph(cmd_graph, drop_skills=conf["drop_skills"],
+                                                            add_cmds=conf["spice"]["allowed_commands"])
 
-            log.debug(cmd_graph.to_text_repr(suppress_args=False))
+            log.debug("%s", Deferred(cmd_graph.to_text_repr, suppress_args=False))
 
             # Randomize bosses
             # FIXME: make flag for "allow bosses to be in pool" (currently true)
             bosses = sset & BOSSES
 
             required = {0xFC, 0xF9, 0xF7, 0xFB, 0xF5}
-            for name in bosses:
-                log.debug(f"Randomizing boss {name} ({len(pool[name]._bytes)} vanilla bytes)")
+            # FIXME: need to give full list from pool
+            boss_area = f"area {set_idx} (bosses)"
+            with timer("boss_templates", set_idx=set_idx):
+                for name in bosses:
+                    log.debug(f"Randomizing boss {name} ({len(pool[name]._bytes)} vanilla bytes)")
+
+                    rcmd_graph = command_graph.RestrictedCommandGraph.get_rule_set(*conf["rules"],
+                                                                                   graph=cmd_graph)
+                    # up the difficulty for bosses a bit
+                    if conf["difficulty"] == "progressive":
+                        difficulty = progressive_difficulty(set_idx, is_boss=True)
+                    else:
+                        difficulty = conf["difficulty"]
+                    # FIXME: can separate these out at some point
+                    rcmd_graph.regulate_difficulty(difficulty, difficulty, ranking=skill_tiers)
+
+                    # This only reduces the length from the original script
+                    bscr = rcmd_graph.generate_from_template(pool[name]._bytes,
+                                                             required=required,
+                                                             drop_events=conf["drop_events"])
+
+                    mod_scripts[name] = scripting.Script(bytes(bscr), name)
+
+                    # The bosses of an area share the graph and difficulty
+                    if boss_area not in _meta.areas:
+                        _meta.add_area(boss_area, sset, difficulty, Deferred(rcmd_graph.to_text_repr))
+                    _meta.add_script(name, "from template", boss_area)
+
+                    extra_space += len(pool[name]._bytes) - len(mod_scripts[name]._bytes)
+                    log.debug(f"to {len(mod_scripts[name]._bytes)} modified bytes.\n"
+                              f"(Before) Vanilla ptr: {t1} [{hex(t1)}] | modified ptr: {t2} [{hex(t2)}]\n"
+                              f"{len(mod_scripts)} modified script so far.")
+                    t1 += len(pool[name]._bytes)
+                    t2 += len(mod_scripts[name]._bytes)
+                    log.debug(f"(After) Vanilla ptr: {t1} [{hex(t1)}] | modified ptr: {t2} [{hex(t2)}]) "
+                              f"| extra space {extra_space} [{hex(extra_space)}]")
+
+                    log.debug(f"--- {name} ---")
+                    log.debug("Created from %s + ", sset)
+                    # Empty FC blocks can be inherited from the original script
+                    scripting.Script.validate(bytes(bscr), allow_empty_fc=True)
+                    assert len(mod_scripts[name]._bytes) >= 2 and len(pool[name]._bytes) >= 2
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug("\n" + tableau_scripts(pool[name].translate(),
+                                                         mod_scripts[name].translate()))
+
+                    assert len(pool[name]._bytes) >= len(mod_scripts[name]._bytes), (name, len(pool[name]._bytes),  len(mod_scripts[name]._bytes))
+
+            # NOTE: we may want to somehow preserve them, but they keep injecting a lot of 0xFC into scripts
+            # Drop "bosses" for now
+            with timer("area_graph", set_idx=set_idx):
+                cmd_graph = pool_counts.graph({k: pool[k] for k in sset - BOSSES}, backend=conf["graph_backend"])
+
+                # Spice goes here
+                # Add in a random status/element theme
+                # TODO: adjust spice based on difficulty
+                command_graph.augment_cmd_graph(cmd_graph, status=conf["spice"]["normal_status"],
+                                                           elemental=conf["spice"]["normal_elemental"],
+                                                           command=conf["spice"]["normal_command"])
+                command_graph.edit_cmd_arg_graph(cmd_graph, drop_skills=conf["drop_skills"],
+                                                            add_cmds=conf["spice"]["allowed_commands"])
+                # FIXME: what was this for and can it go away?
+                assert 0xC2 not in cmd_graph.cmd_graph
 
                 rcmd_graph = command_graph.RestrictedCommandGraph.get_rule_set(*conf["rules"],
                                                                                graph=cmd_graph)
-                # up the difficulty for bosses a bit
-                if conf["difficulty"] == "progressive":
-                    difficulty = progressive_difficulty(set_idx, is_boss=True)
-                else:
-                    difficulty = conf["difficulty"]
+                # FIXME: we only use one out of the set for now
+                difficulty = progressive_difficulty(set_idx) \
+                                if conf["difficulty"] == "progressive" \
+                                else conf["difficulty"]
                 # FIXME: can separate these out at some point
                 rcmd_graph.regulate_difficulty(difficulty, difficulty, ranking=skill_tiers)
 
-                # This only reduces the length from the original script
-                bscr = rcmd_graph.generate_from_template(pool[name]._bytes,
-                                                         required=required,
-                                                         drop_events=conf["drop_events"])
-
-                mod_scripts[name] = scripting.Script(bytes(bscr), name)
-
-                _meta[name] = "type: from template\n"
-                # FIXME: need to give full list from pool
-                _meta[name] += f"created from: {sset}\n"
-                _meta[name] += f"difficulty rating: {difficulty}\n"
-                _meta[name] += rcmd_graph.to_text_repr()
-
-                extra_space += len(pool[name]._bytes) - len(mod_scripts[name]._bytes)
-                log.debug(f"to {len(mod_scripts[name]._bytes)} modified bytes.\n"
-                          f"(Before) Vanilla ptr: {t1} [{hex(t1)}] | modified ptr: {t2} [{hex(t2)}]\n"
-                          f"{len(mod_scripts)} modified script so far.")
-                t1 += len(pool[name]._bytes)
-                t2 += len(mod_scripts[name]._bytes)
-                log.debug(f"(After) Vanilla ptr: {t1} [{hex(t1)}] | modified ptr: {t2} [{hex(t2)}]) "
-                          f"| extra space {extra_space} [{hex(extra_space)}]")
-
-                log.debug(f"--- {name} ---")
-                log.debug(f"Created from {sset} + ")
-                # Empty FC blocks can be inherited from the original script
-                scripting.Script.validate(bytes(bscr), allow_empty_fc=True)
-                assert len(mod_scripts[name]._bytes) >= 2 and len(pool[name]._bytes) >= 2
-                log.debug("\n" + tableau_scripts(pool[name].translate(),
-                                                 mod_scripts[name].translate()))
-
-                assert len(pool[name]._bytes) >= len(mod_scripts[name]._bytes), (name, len(pool[name]._bytes),  len(mod_scripts[name]._bytes))
-
-            cmd_graph = command_graph.CommandGraph()
-            # NOTE: we may want to somehow preserve them, but they keep injecting a lot of 0xFC into scripts
-            # Drop "bosses" for now
-            cmd_graph.from_scripts({k: pool[k]._bytes for k in sset - BOSSES})
-
-            # Spice goes here
-            # Add in a random status/element theme
-            # TODO: adjust spice based on difficulty
-            command_graph.augment_cmd_graph(cmd_graph, status=conf["spice"]["normal_status"],
-                                                       elemental=conf["spice"]["normal_elemental"],
-                                                       command=conf["spice"]["normal_command"])
-            command_graph.edit_cmd_arg_graph(cmd_graph, drop_skills=conf["drop_skills"],
-                                                        add_cmds=conf["spice"]["allowed_commands"])
-            # FIXME: what was this for and can it go away?
-            assert 0xC2 not in cmd_graph.cmd_graph
-
-            rcmd_graph = command_graph.RestrictedCommandGraph.get_rule_set(*conf["rules"],
-                                                                           graph=cmd_graph)
-            # FIXME: we only use one out of the set for now
-            difficulty = progressive_difficulty(set_idx) \
-                            if conf["difficulty"] == "progressive" \
-                            else conf["difficulty"]
-            # FIXME: can separate these out at some point
-            rcmd_graph.regulate_difficulty(difficulty, difficulty, ranking=skill_tiers)
-
-            log.debug(rcmd_graph.to_text_repr())
+                log.debug("%s", Deferred(rcmd_graph.to_text_repr))
 
             # bosses have already been randomized
             sset -= BOSSES
 
+            if sset:
+                _meta.add_area(f"area {set_idx}", sset, difficulty,
+                               Deferred(cmd_graph.to_text_repr, suppress_args=False))
             for name in sset:
-                _meta[name] = "type: from graph\n"
-                _meta[name] += f"created from: {sset}\n"
-                _meta[name] += f"difficulty rating: {difficulty}\n"
-                _meta[name] += cmd_graph.to_text_repr(suppress_args=False)
+                _meta.add_script(name, "from graph", f"area {set_idx}")
 
             # Total length of scripts + extra_space
             # extra_space is basically the offset from the vanilla pointer
@@ -331,15 +366,18 @@ if __name__ == "__main__":
             # increment vanilla pointer
             t1 += total_len - extra_space
 
-            log.debug(f"Randomizing over {pool}")
+            log.debug("Randomizing over %s", pool)
 
             main_block_avg = max(int(math.log2(max(total_len, 1) + extra_space) / max(1, len(sset))), 1)
+            _metrics[set_idx] = command_graph.GenerationMetrics()
             gen_kwargs = {"disallow_commands": {0xF7, 0xF2},
-                          "naborts": conf["num_retries"]}
-            _scr, _ptrs = pack.randomize_scripts(rcmd_graph, n=len(sset),
-                                                 #main_block_avg=main_block_avg,
-                                                 main_block_avg=5,
-                                                 total_len=total_len, **gen_kwargs)
+                          "naborts": conf["num_retries"],
+                          "metrics": _metrics[set_idx]}
+            with timer("randomize_scripts", set_idx=set_idx):
+                _scr, _ptrs = pack.randomize_scripts(rcmd_graph, n=len(sset),
+                                                     #main_block_avg=main_block_avg,
+                                                     main_block_avg=5,
+                                                     total_len=total_len, **gen_kwargs)
             assert sum(map(len, _scr)) <= total_len, "Script block length exceeds request."
 
             # DEBUG
@@ -351,7 +389,8 @@ if __name__ == "__main__":
             t2 += sum(map(len, _scr))
             extra_space = total_len - sum(map(len, _scr))
             log.debug("v. ptr | m. ptr | ptr diff | total m. bytes | allowed m. bytes | extra | m. set")
-            log.debug(" | ".join(map(str, (hex(t1), hex(t2), (t2 - t1), sum(map(len, _scr)),total_len, extra_space, sset))))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(" | ".join(map(str, (hex(t1), hex(t2), (t2 - t1), sum(map(len, _scr)),total_len, extra_space, sset))))
 
             # This means that the enemy has been randomized more than once. In the interests of keeping
             # bookkeeping more simple, we'll just explicitly disallow this for now
@@ -365,22 +404,27 @@ if __name__ == "__main__":
 
             for name in sset:
                 log.debug(f"--- {name} ---")
-                log.debug(f"Created from {sset} + ")
-                scripting.Script.validate(mod_scripts[name]._bytes)
-                log.debug("\n" + tableau_scripts(pool[name].translate(),
-                                                 mod_scripts[name].translate()))
+                log.debug("Created from %s + ", sset)
+                # Already checked during generation
+                if not rcmd_graph.VALIDATES_OUTPUT:
+                    scripting.Script.validate(mod_scripts[name])
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("\n" + tableau_scripts(pool[name].translate(),
+                                                     mod_scripts[name].translate()))
 
         # Realign pointers
         export = scripts.get_ordered_script_array()
         for n, s in mod_scripts.items():
             export[scripts._get_index(n)] = s
-        script_length_after = sum(map(len, export))
-        logging.debug(hex(0xFC050 - 0xF8700), hex(script_length_after))
+        # Gather everything into one buffer, packing and verification work off of views into it
+        export = scripting.ScriptTable.from_scripts(export)
+        script_length_after = export.nbytes
+        log.debug("%s %s", hex(0xFC050 - 0xF8700), hex(script_length_after))
 
         # Split the enemies into scripts that need to be written
         # first, so as to not soft-lock the game at some point
         # because of truncation
-        write_first = set(extract.identify_special_event_scripts(scripts.scripts).values())
+        write_first = set(scripts.opcode_index.scripts_with(syntax.SpecialEvent))
         write_first |= {scripts._get_index(n) for n in BOSSES | conf["do_not_randomize"]}
 
         # TODO: Account for this in budget
@@ -391,34 +435,44 @@ if __name__ == "__main__":
             blk = scripts.script_blocks[0]
             scripts.script_blocks[0] = (blk[0] + _ESPER_TARGET_PATCH_LEN, blk[1])
 
-            romfile = apply_esper_target_patch(romfile)
+            with timer("esper_target_patch"):
+                romfile = apply_esper_target_patch(romfile)
 
-        scr, ptrs = pack.pack_scripts(export, names, scripts.script_blocks,
-                                      write_first=write_first)
+        with timer("pack_scripts"):
+            scr, ptrs = pack.pack_scripts(export, names, scripts.script_blocks,
+                                          write_first=write_first)
         # Rewrite to address space
-        plen = len(romfile)
-        romfile = pack.write_script_blocks(romfile, {(0xF8400, 0xF8700): ptrs, **scr})
-        assert plen == len(romfile)
+        with timer("write_rom"):
+            plen = len(romfile)
+            romfile = pack.write_script_blocks(romfile, {(0xF8400, 0xF8700): ptrs, **scr})
+            assert plen == len(romfile)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"{len(romfile.patches)} writes to ROM, changed ranges: "
+                      + ", ".join([f"({hex(low)}, {hex(hi)})" for low, hi in romfile.changed_ranges()]))
 
         if fname.endswith(".smc"):
             outfname = fname.replace(".smc", f".ai_rando_{i}.smc")
         else:
             outfname = f"FF3.ai_rando_{i}.smc"
 
-        with open(outfname, "wb") as fout:
+        with timer("write_rom"), open(outfname, "wb") as fout:
             fout.write(bytes(romfile))
         log.info(f"Generated ROM at {outfname}")
 
         spoiler = outfname.replace(".smc", f".spoiler_{i}.txt")
-        with open(spoiler, "w") as fout:
+        with timer("write_spoiler"), open(spoiler, "w") as fout:
+            # What the scripts share is written once, up front
+            print("=== Generation pools ===", file=fout)
+            print(_meta.render_areas(), file=fout)
+            print("=== Scripts ===", file=fout)
             for j, s in enumerate(export):
                 n = names[j]
                 _n = _NAME_ALIASES.get(j, n)
                 print(f"--[{str(j).ljust(3)}]-- {_n} ({n}) ---", file=fout)
                 if n in _meta:
-                    print(_meta[n], file=fout)
+                    print(_meta.render(n), file=fout)
                 elif s.name in _meta:
-                    print(_meta[s.name], file=fout)
+                    print(_meta.render(s.name), file=fout)
 
                 print(f"Original | Randomized", file=fout)
                 if n in mod_scripts or s.name in mod_scripts:
@@ -431,9 +485,31 @@ if __name__ == "__main__":
                 print("", file=fout)
         log.info(f"Generated script spoiler at {spoiler}")
 
+        if conf["generation_metrics"]:
+            total = command_graph.GenerationMetrics()
+            for m in _metrics.values():
+                total += m
+            metrics_file = outfname.replace(".smc", f".metrics_{i}.json")
+            with open(metrics_file, "w") as fout:
+                json.dump({"rom": fname,
+                           "seed": conf.get("random_seed", 0),
+                           "areas": {set_idx: m.to_dict() for set_idx, m in _metrics.items()},
+                           "total": total.to_dict()}, fout, indent=1)
+            log.info(f"Wrote generation metrics to {metrics_file}")
+
         if conf['verify_rom']:
             log.info(f"Rechecking and verifying {outfname}")
             outfname = os.path.realpath(outfname)
-            verify_rom(outfname, export, names,
-                       main_block_start=scripts.script_blocks[0][0])
+            with timer("verify_rom"):
+                verify_rom(outfname, export, names,
+                           main_block_start=scripts.script_blocks[0][0])
             log.info(f"Verification successful")
+
+        if conf["timing_report"]:
+            timing_file = outfname.replace(".smc", f".timing_{i}.jsonl")
+            timer.write(timing_file)
+            log.info(f"Wrote phase timings to {timing_file}")
+        timings += timer.records
+
+    if conf["timing_summary"]:
+        log.info("Phase timings over the batch:\n" + timing.summarize(timings))
@@ -0,0 +1,159 @@
+import os
+import struct
+import hashlib
+import logging
+log = logging.getLogger("ai_scribe")
+
+import numpy
+
+from .scripting import ScriptTable
+
+# Bump this if the on-disk layout below changes
+_CACHE_FORMAT = 2
+_MAGIC = b"AISCRIBE"
+_HEADER = struct.Struct("<8sHHB")
+
+def cache_dir():
+    """
+    Directory where extraction results are stored. Can be overridden with the `AI_SCRIBE_CACHE_DIR`
+    environment variable, otherwise the platform's user cache directory is used.
+    """
+    if "AI_SCRIBE_CACHE_DIR" in os.environ:
+        return os.environ["AI_SCRIBE_CACHE_DIR"]
+    base = os.environ.get("LOCALAPPDATA") if os.name == "nt" else None
+    base = base or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ai_scribe")
+
+def rom_digest(romfile):
+    """
+    SHA-256 hex digest of the ROM contents.
+    """
+    return hashlib.sha256(romfile[:]).hexdigest()
+
+def _cache_path(digest):
+    return os.path.join(cache_dir(), f"{digest}.bin")
+
+def _pack_strs(strs):
+    out = [struct.pack("<H", len(strs))]
+    for s in strs:
+        s = s.encode("utf-8")
+        out += [struct.pack("<H", len(s)), s]
+    return out
+
+def _unpack_strs(data, off):
+    n, = struct.unpack_from("<H", data, off)
+    off += 2
+    strs = []
+    for _ in range(n):
+        slen, = struct.unpack_from("<H", data, off)
+        off += 2
+        strs.append(data[off:off + slen].decode("utf-8"))
+        off += slen
+    return strs, off
+
+def _encode(record, parser_version):
+    out = [_HEADER.pack(_MAGIC, _CACHE_FORMAT, parser_version, record["is_bc"])]
+
+    ptrs = record["script_ptrs"]
+    out += [struct.pack("<H", len(ptrs)), struct.pack(f"<{len(ptrs)}I", *ptrs)]
+
+    blocks = record["script_blocks"]
+    out.append(struct.pack("<H", len(blocks)))
+    out += [struct.pack("<II", low, hi) for low, hi in blocks]
+
+    # The script table is stored as is: names, pointers and bounds followed by the data
+    table = record["table"]
+    n = len(table)
+    out += [struct.pack("<HI", n, len(table.data)),
+            struct.pack(f"<{n}H", *table.names), struct.pack(f"<{n}I", *table.ptrs),
+            struct.pack(f"<{n}I", *table.starts.tolist()), struct.pack(f"<{n}I", *table.ends.tolist()),
+            bytes(table.data)]
+
+    out += _pack_strs(record["canonical_names"])
+    out += _pack_strs(record["aliased_names"])
+    return b"".join(out)
+
+def _decode(data, parser_version):
+    magic, fmt, version, is_bc = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC or fmt != _CACHE_FORMAT or version != parser_version:
+        return None
+    off = _HEADER.size
+
+    n, = struct.unpack_from("<H", data, off)
+    ptrs = [*struct.unpack_from(f"<{n}I", data, off + 2)]
+    off += 2 + 4 * n
+
+    n, = struct.unpack_from("<H", data, off)
+    off += 2
+    blocks = [struct.unpack_from("<II", data, off + 8 * i) for i in range(n)]
+    off += 8 * n
+
+    n, nbytes = struct.unpack_from("<HI", data, off)
+    off += 6
+    names = struct.unpack_from(f"<{n}H", data, off)
+    off += 2 * n
+    script_ptrs = struct.unpack_from(f"<{n}I", data, off)
+    off += 4 * n
+    starts = struct.unpack_from(f"<{n}I", data, off)
+    off += 4 * n
+    ends = struct.unpack_from(f"<{n}I", data, off)
+    off += 4 * n
+    if off + nbytes > len(data):
+        raise struct.error("script table data is truncated")
+    table = ScriptTable(data[off:off + nbytes], starts, ends, names=names, ptrs=script_ptrs)
+    off += nbytes
+
+    canonical_names, off = _unpack_strs(data, off)
+    aliased_names, off = _unpack_strs(data, off)
+
+    return {
+        "table": table,
+        "script_ptrs": numpy.array(ptrs, dtype=numpy.int64),
+        "script_blocks": blocks,
+        "canonical_names": canonical_names,
+        "aliased_names": aliased_names,
+        "is_bc": bool(is_bc),
+    }
+
+def load(digest, parser_version):
+    """
+    Load the extraction record for the ROM with the given digest.
+
+    :param digest: `str` digest of the ROM, see `rom_digest`
+    :param parser_version: `int` current version of the parser, stale records are ignored
+    :return: `dict` with the extraction results, or `None` if there is no valid record
+    """
+    try:
+        with open(_cache_path(digest), "rb") as fin:
+            data = fin.read()
+    except OSError:
+        return None
+
+    try:
+        return _decode(data, parser_version)
+    except (struct.error, UnicodeDecodeError) as e:
+        log.debug(f"Discarding corrupt extraction cache entry for {digest}: {e}")
+        return None
+
+def save(digest, parser_version, record):
+    """
+    Store an extraction record for the ROM with the given digest. Failures are logged and otherwise ignored.
+    """
+    try:
+        data = _encode(record, parser_version)
+    except struct.error as e:
+        log.debug(f"Extraction results for {digest} cannot be cached: {e}")
+        return
+
+    path = _cache_path(digest)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write and move, so that concurrent runs never see a partial file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"Could not write extraction cache to {path}: {e}")
+        return
+    log.debug(f"Cached extraction results at {path}")
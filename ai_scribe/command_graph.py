@@ -1,76 +1,690 @@
 import math
+import bisect
 import random
-from collections import defaultdict
+import logging
+log = logging.getLogger("ai_scribe")
+from collections import Counter, defaultdict
 
 import networkx
 import numpy
 
+from . import Deferred
 from . import flags
 from . import syntax
 from . import themes
+from .scripting import tokenize, StreamingValidator, RuleContext
 from .syntax import SYNTAX
 from .themes import ELEM_THEMES, STATUS_THEMES, FROM_COMMANDS
 
+class ArgGraphSampler:
+    """
+    An argument graph compiled for sampling. The neighbours of every node are stored in CSR form
+    (`indptr` into `indices`) next to their running edge weights, so drawing the next argument is a
+    binary search over the neighbours of the current node. Edges without a weight count as 1.
+
+    This is a snapshot: edits to the graph afterwards are not seen, compile it again instead.
+    """
+    def __init__(self, arg_g, allowed=None):
+        """
+        :param allowed: if given, only keep edges leading to these nodes
+        """
+        self._pos = {node: i for i, node in enumerate(arg_g.nodes)}
+        self.indptr, self.indices, self.cumweights = [0], [], []
+        for node in arg_g.nodes:
+            total = 0
+            for v, d in arg_g[node].items():
+                if allowed is not None and v not in allowed:
+                    continue
+                total += d.get("weight", 1)
+                self.indices.append(v)
+                self.cumweights.append(total)
+            self.indptr.append(len(self.indices))
+
+    def __contains__(self, node):
+        return node in self._pos
+
+    def neighbors(self, node):
+        i = self._pos[node]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def has_choices(self, node):
+        """
+        Whether `node` has a neighbour with nonzero weight, i.e. `choice` can draw one. Draws nothing.
+        """
+        if node not in self._pos:
+            return False
+        i = self._pos[node]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return lo < hi and self.cumweights[hi - 1] > 0
+
+    def choice(self, node, rng=None):
+        """
+        Draw a neighbour of `node`, with probability proportional to the edge weight.
+
+        :param rng: `RandomPool` to draw from, defaults to `RNG_POOL`
+
+        :raises KeyError: if `node` is not in the graph
+        :raises IndexError: if `node` has no neighbours (with nonzero weight)
+        """
+        i = self._pos[node]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        if lo == hi or self.cumweights[hi - 1] <= 0:
+            raise IndexError(f"{node} has no neighbours to choose from")
+        u = (rng or RNG_POOL).random() * self.cumweights[hi - 1]
+        return self.indices[min(bisect.bisect_right(self.cumweights, u, lo, hi), hi - 1)]
+
+def _arg_graph_edited(arg_g):
+    """
+    Mark an argument graph as edited, so that `RestrictedCommandGraph.regulate_difficulty` redoes its weights.
+    Composed graphs carry the mark of their parts over, so they need this as well.
+    """
+    arg_g.graph.pop("regulated", None)
+    return arg_g
+
 # FIXME: to syntax (attached to Cmd?)
-def expand(arg_g, cmd_byte=0xF0, nargs=3):
+def expand(arg_g, cmd_byte=0xF0, nargs=3, rng=None):
+    """
+    Walk the argument graph from `cmd_byte` to draw `nargs` arguments, going back to the command
+    whenever the walk runs into a dead end.
+
+    :param arg_g: `networkx.DiGraph` or `ArgGraphSampler` compiled from one
+    :param rng: `RandomPool` to draw from, defaults to `RNG_POOL`
+    """
+    sampler = arg_g if isinstance(arg_g, ArgGraphSampler) else ArgGraphSampler(arg_g)
     stack = []
 
-    gptr = arg_g[cmd_byte]
-    assert len(gptr) > 0 and set(gptr) != {cmd_byte}
+    choices = sampler.neighbors(cmd_byte)
+    assert len(choices) > 0 and set(choices) != {cmd_byte}
+    gptr = cmd_byte
     while len(stack) < nargs:
         try:
-            gptr = random.choice(list(gptr))
+            gptr = sampler.choice(gptr, rng)
         except IndexError:
             gptr = cmd_byte
 
         if gptr != cmd_byte:
             stack.append(gptr)
-        gptr = arg_g[gptr]
 
     return stack
 
-def _bind_token(cmd, script, arg_graph, shuffle_args=False):
-    for arg, descr in cmd.parse_args(script):
-        arg_graph.add_node(arg, type="generic", descr=descr)
-        if shuffle_args:
-            arg_graph.add_edge(arg, cmd._BYTEVALUE)
+# Fixed node ordering for the dense transition backend: the commands, DO SKILL and the start marker
+OPCODE_INDEX = [*range(0xF0, 0x100), syntax.DoSkill._BYTEVAL, "^"]
+_OPCODE_POS = {op: i for i, op in enumerate(OPCODE_INDEX)}
+
+def _syntax_mask():
+    """
+    `apply_syntax_rules` only depends on the current node, so it can be applied to whole rows at once.
+    """
+    mask = numpy.ones((len(OPCODE_INDEX), len(OPCODE_INDEX)))
+    for i, gptr in enumerate(OPCODE_INDEX):
+        weights = dict.fromkeys(OPCODE_INDEX, 1)
+        syntax.apply_syntax_rules(gptr, weights)
+        mask[i] = [weights[op] for op in OPCODE_INDEX]
+    return mask
+_SYNTAX_MASK = _syntax_mask()
+
+class RandomPool:
+    """
+    Uniform random numbers in [0, 1), drawn from a `numpy.random.Generator` in large blocks so that
+    taking them one at a time does not pay for a numpy call each time.
+    """
+    def __init__(self, seed=None, block_size=4096):
+        self.block_size = block_size
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self._rng = numpy.random.default_rng(seed)
+        self._block = []
+
+    def random(self):
+        if not self._block:
+            self._block = self._rng.random(self.block_size).tolist()
+        return self._block.pop()
+
+    def randint(self, a, b):
+        """
+        Random integer in [a, b], both included (as `random.randint`).
+        """
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+    def poisson(self, lam):
+        return int(self._rng.poisson(lam))
+
+# Shared by the samplers below, seeded along with the other RNGs in __main__
+RNG_POOL = RandomPool()
+
+def _alias_table(p):
+    """
+    Walker / Vose alias table for the distribution `p`, returned as (probability, alias) arrays.
+    Drawing `i` uniformly, then keeping it with probability `prob[i]` (or else taking `alias[i]`)
+    samples from `p` in constant time.
+    """
+    n = len(p)
+    prob, alias = numpy.zeros(n), numpy.arange(n)
+    scaled = numpy.asarray(p, dtype=float) * n
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] += scaled[s] - 1
+        (small if scaled[l] < 1 else large).append(l)
+
+    # Whatever is left over is only off by rounding, but never pick impossible entries
+    for i in small + large:
+        if p[i] > 0:
+            prob[i] = 1
+        else:
+            prob[i], alias[i] = 0, numpy.argmax(p)
+    return prob, alias
+
+class TransitionMatrix:
+    """
+    Dense storage of the command transitions of a `CommandGraph`.
+
+    `weights[i, j]` is the weight of the transition `OPCODE_INDEX[i]` -> `OPCODE_INDEX[j]`. For sampling,
+    the rows (after applying the syntax rules) are normalized and turned into alias tables once, so drawing
+    the next command takes constant time. The equivalent `networkx.DiGraph` is available as
+    `graph`, which is built on demand. Edits to that graph are not reflected back here. Edit through
+    the methods below rather than `weights` directly, so that `version` is bumped and cached data dropped.
+    """
+    def __init__(self):
+        self.weights = numpy.zeros((len(OPCODE_INDEX), len(OPCODE_INDEX)))
+        self.nodes = numpy.zeros(len(OPCODE_INDEX), dtype=bool)
+        self._invalidate()
+
+    @classmethod
+    def from_graph(cls, g):
+        tmat = cls()
+        for node in g.nodes:
+            tmat.nodes[_OPCODE_POS[node]] = True
+        for u, v, d in g.edges(data=True):
+            tmat.weights[_OPCODE_POS[u], _OPCODE_POS[v]] = d.get("weight", 1)
+        return tmat
+
+    def copy(self):
+        tmat = TransitionMatrix()
+        tmat.weights[:] = self.weights
+        tmat.nodes[:] = self.nodes
+        return tmat
+
+    def _invalidate(self):
+        # Bumped on every edit, so derived data elsewhere can tell it is stale
+        self.version = getattr(self, "version", -1) + 1
+        self._cdf = {}
+        self._alias = {}
+        self._masked = {}
+        self._live = {}
+        self._graph = None
+
+    def __contains__(self, node):
+        return node in _OPCODE_POS and self.nodes[_OPCODE_POS[node]]
+
+    def successors(self, node):
+        return [OPCODE_INDEX[j] for j in numpy.flatnonzero(self.weights[_OPCODE_POS[node]])]
+
+    def add_transition(self, u, v, weight=1):
+        i, j = _OPCODE_POS[u], _OPCODE_POS[v]
+        self.nodes[[i, j]] = True
+        self.weights[i, j] += weight
+        self._invalidate()
+
+    def add_weights(self, weights):
+        """
+        Add a whole matrix of transition weights, the nodes involved are added as well.
+        """
+        self.weights += weights
+        self.nodes |= (weights != 0).any(axis=0) | (weights != 0).any(axis=1)
+        self._invalidate()
+
+    def contract(self, u, v):
+        """
+        Merge node `v` into `u`, as `networkx.contracted_nodes` does: edges to and from `v` are moved to `u`,
+        replacing (not adding to) the weight of any existing edge.
+        """
+        i, j = _OPCODE_POS[u], _OPCODE_POS[v]
+        out, inc = self.weights[j].copy(), self.weights[:, j].copy()
+        self.weights[j], self.weights[:, j] = 0, 0
+        self.nodes[j] = False
+
+        for k in numpy.flatnonzero(out):
+            self.weights[i, i if k == j else k] = out[k]
+        for k in numpy.flatnonzero(inc):
+            self.weights[i if k == j else k, i] = inc[k]
+        self._invalidate()
+
+    def for_generation(self, start_cmd="^", disallow_commands=set()):
+        """
+        Copy of the matrix with the modifications `RestrictedCommandGraph.generate_from_graph` makes
+        to the command graph before generating from it.
+        """
+        tmat = self.copy()
+        weights = tmat.weights
+
+        # Nullify the outgoing links to block enders, and link nodes left terminal to the start
+        weights[:, [_OPCODE_POS[0xFE], _OPCODE_POS[0xFF]]] = 0
+        terminal = tmat.nodes & (weights.sum(axis=1) == 0)
+        if terminal.any():
+            weights[terminal, _OPCODE_POS["^"]] = 1
+            tmat.nodes[_OPCODE_POS["^"]] = True
+
+        # Contract away the disallowed commands, see generate_from_graph
+        start = _OPCODE_POS[start_cmd]
+        for gptr in [op for op in OPCODE_INDEX if op in tmat and op not in disallow_commands]:
+            for cmd in set(tmat.successors(gptr)) & disallow_commands:
+                weights[_OPCODE_POS[cmd], start] = 0
+                weights[start, _OPCODE_POS[cmd]] = 0
+                tmat.contract(gptr, cmd)
+
+        tmat._invalidate()
+        return tmat
+
+    def cdf(self, weighted=True):
+        """
+        Normalized cumulative transition probabilities for every node, with the syntax rules applied.
+        Rows for nodes without valid transitions are all zero.
+        """
+        if weighted not in self._cdf:
+            weights = self.weights * _SYNTAX_MASK
+            if not weighted:
+                weights = (weights > 0).astype(float)
+            cdf = numpy.cumsum(weights, axis=1)
+            norm = cdf[:, -1:]
+            self._cdf[weighted] = numpy.divide(cdf, norm, out=numpy.zeros_like(cdf), where=norm > 0)
+        return self._cdf[weighted]
+
+    def sample(self, gptr, weighted=True, exclude=None, u=None):
+        """
+        Draw the command following `gptr`.
+
+        :param exclude: optional `frozenset` of commands not to draw
+        :param u: uniform number in [0, 1) to draw with, by default taken from `RNG_POOL`
+        :raises KeyError: if `gptr` has no valid outgoing transitions
+        """
+        if gptr not in self:
+            raise KeyError(f"Current command pointer ({gptr}) is not in the command graph.")
+        i = _OPCODE_POS[gptr]
+        exclude = self._live_exclude(i, exclude) if exclude else None
+        if exclude:
+            prob, alias, valid = self._masked_alias(weighted, i, exclude)
+        else:
+            prob, alias = self.alias_tables(weighted)
+            prob, alias, valid = prob[i], alias[i], self._alias[weighted][2][i]
+        if not valid:
+            raise KeyError(f"gptr has no valid choices.\ngptr: {gptr}")
+
+        # Alias method: one uniform picks the column and decides whether to take its alias
+        u = (RNG_POOL.random() if u is None else u) * len(OPCODE_INDEX)
+        j = int(u)
+        return OPCODE_INDEX[j if u - j < prob[j] else alias[j]]
+
+    def _live_exclude(self, i, exclude):
+        """
+        The commands of `exclude` which row `i` could draw at all, masking the others changes nothing.
+        """
+        key = (i, exclude)
+        if key not in self._live:
+            self._live[key] = frozenset(c for c in exclude if c in _OPCODE_POS
+                                        and self.weights[i, _OPCODE_POS[c]] * _SYNTAX_MASK[i, _OPCODE_POS[c]] > 0)
+        return self._live[key]
+
+    def _masked_alias(self, weighted, i, exclude):
+        """
+        Alias table of row `i` without the transitions to `exclude`, as (prob, alias, valid).
+        """
+        key = (weighted, i, exclude)
+        if key not in self._masked:
+            row = numpy.diff(self.cdf(weighted)[i], prepend=0)
+            row[[_OPCODE_POS[c] for c in exclude if c in _OPCODE_POS]] = 0
+            total = row.sum()
+            if total > 0:
+                prob, alias = _alias_table(row / total)
+                self._masked[key] = (prob.tolist(), alias.tolist(), True)
+            else:
+                self._masked[key] = (None, None, False)
+        return self._masked[key]
+
+    def sample_many(self, gptrs, u, weighted=True, excludes=None):
+        """
+        Vectorized `sample`: draw the command following each of `gptrs` at once, given one uniform
+        number in [0, 1) for each of them in `u`.
+
+        :param excludes: optional `list` with the commands not to draw for each of `gptrs` (see `sample`)
+        :return: `list` of the drawn commands, None where there is no valid outgoing transition
+        """
+        prob, alias, valid = self.alias_arrays(weighted)
+        rows = numpy.array([_OPCODE_POS.get(gptr, -1) for gptr in gptrs], dtype=int)
+        ok = (rows >= 0) & valid[rows]
+
+        scaled = numpy.asarray(u) * len(OPCODE_INDEX)
+        cols = scaled.astype(int)
+        cols = numpy.where(scaled - cols < prob[rows, cols], cols, alias[rows, cols])
+        drawn = [OPCODE_INDEX[j] if k else None for j, k in zip(cols.tolist(), ok.tolist())]
+
+        # Only rows where the mask takes out something they could draw are drawn again, one by one
+        for k, exclude in enumerate(excludes or []):
+            if exclude and rows[k] >= 0 and self._live_exclude(rows[k], exclude):
+                try:
+                    drawn[k] = self.sample(gptrs[k], weighted, exclude=exclude, u=float(u[k]))
+                except KeyError:
+                    drawn[k] = None
+        return drawn
+
+    def alias_arrays(self, weighted=True):
+        """
+        `alias_tables` as arrays, along with which nodes have valid transitions at all.
+        """
+        self.alias_tables(weighted)
+        return self._alias[weighted][3]
+
+    def alias_tables(self, weighted=True):
+        """
+        Per node alias tables (see `_alias_table`) for the rows of `cdf`, as (prob, alias) matrices.
+        """
+        if weighted not in self._alias:
+            cdf = self.cdf(weighted)
+            tables = [_alias_table(row) for row in numpy.diff(cdf, axis=1, prepend=0)]
+            valid = self.nodes & (cdf[:, -1] > 0)
+            # Plain lists are quicker to index one element at a time, arrays for sample_many
+            self._alias[weighted] = ([t[0].tolist() for t in tables], [t[1].tolist() for t in tables],
+                                     valid.tolist(),
+                                     (numpy.array([t[0] for t in tables]), numpy.array([t[1] for t in tables]), valid))
+        return self._alias[weighted][:2]
+
+    @property
+    def graph(self):
+        """
+        The transitions as a `networkx.DiGraph`, laid out as `CommandGraph.from_script` would make it.
+        """
+        if self._graph is None:
+            g = networkx.DiGraph()
+            for node in numpy.array(OPCODE_INDEX, dtype=object)[self.nodes]:
+                if node in syntax.Cmd._CMD_REG:
+                    cmd = syntax.Cmd._CMD_REG[node]
+                    g.add_node(node, type="command", nbytes=cmd._NARGS, descr=cmd._DESCR)
+                else:
+                    g.add_node(node)
+            for i, j in zip(*numpy.nonzero(self.weights)):
+                w = float(self.weights[i, j])
+                g.add_edge(OPCODE_INDEX[i], OPCODE_INDEX[j], weight=int(w) if w.is_integer() else w)
+            self._graph = g
+        return self._graph
+
+# Node indices of the argument graphs: the byte values, and DO SKILL (whose root is not a byte)
+_ARG_NODES = 0x101
+_ARG_ROOT_SKILL = 0x100
+# Position in OPCODE_INDEX of the command each byte value stands for, skills are DO SKILL
+_CMD_CODE = numpy.array([_OPCODE_POS[b] if b >= 0xF0 else _OPCODE_POS[syntax.DoSkill._BYTEVAL]
+                         for b in range(0x100)])
+
+# Number of possible argument edge keys, see TransitionCounts
+_ARG_KEYS = len(OPCODE_INDEX) * _ARG_NODES**2
+
+def _arg_node(i):
+    return syntax.DoSkill._BYTEVAL if i == _ARG_ROOT_SKILL else i
+
+def _arg_index(node):
+    return _ARG_ROOT_SKILL if node == syntax.DoSkill._BYTEVAL else node
+
+def _count_tokens(scripts):
+    """
+    Tokenize `scripts` and flatten them into what `TransitionCounts` counts.
+
+    :return: number of scripts, and for the command transitions and the argument edges, the index of the
+        script they are from along with the transition (`prev * len(OPCODE_INDEX) + cmd`) or edge key
+    """
+    data, opcodes, offsets, nargs, ntokens = [], [], [], [], []
+    base = 0
+    for script in scripts:
+        tokens = tokenize(script)
+        script = bytes(script)
+        data.append(script)
+        opcodes.append(tokens["opcode"])
+        offsets.append(tokens["offset"].astype(numpy.int64) + base)
+        nargs.append(tokens["nargs"])
+        ntokens.append(len(tokens))
+        base += len(script)
+
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    if sum(ntokens) == 0:
+        return len(ntokens), empty, empty, empty, empty
+    data = numpy.frombuffer(b"".join(data), dtype=numpy.uint8).astype(numpy.int64)
+    opcodes, offsets = numpy.concatenate(opcodes).astype(numpy.int64), numpy.concatenate(offsets)
+    nargs = numpy.concatenate(nargs).astype(numpy.int64)
+    sid = numpy.repeat(numpy.arange(len(ntokens)), ntokens)
+    # Index of the first token of every (non-empty) script
+    first = numpy.cumsum([0] + ntokens[:-1])[numpy.array(ntokens) > 0]
+
+    # Command transitions, every script starts from the start marker
+    codes = _CMD_CODE[opcodes]
+    prev = numpy.roll(codes, 1)
+    prev[first] = _OPCODE_POS["^"]
+    pairs = prev * len(OPCODE_INDEX) + codes
+
+    # Argument chains: root -> first argument -> second argument ...
+    # A skill byte is the (only) argument of DO SKILL
+    skill = opcodes < 0xF0
+    root = numpy.where(skill, _ARG_ROOT_SKILL, opcodes)
+    start = numpy.where(skill, offsets, offsets + 1)
+    nargs = numpy.where(skill, 1, nargs)
+
+    has = nargs > 0
+    sids, cmds, us, vs = [sid[has]], [codes[has]], [root[has]], [data[start[has]]]
+    for k in range(1, nargs.max(initial=0)):
+        has = nargs > k
+        sids.append(sid[has])
+        cmds.append(codes[has])
+        us.append(data[start[has] + k - 1])
+        vs.append(data[start[has] + k])
+    keys = (numpy.concatenate(cmds) * _ARG_NODES + numpy.concatenate(us)) * _ARG_NODES + numpy.concatenate(vs)
+
+    return len(ntokens), sid, pairs, numpy.concatenate(sids), keys
+
+class TransitionCounts:
+    """
+    How often every command transition and argument edge occurs in a set of scripts, which is what
+    a `CommandGraph` is built from.
+
+    `commands[i, j]` counts the transitions `OPCODE_INDEX[i]` -> `OPCODE_INDEX[j]`. `args` holds the edges
+    of the argument graphs sparsely: `args[0]` are the sorted edge keys `(cmd * _ARG_NODES + u) * _ARG_NODES + v`,
+    with `cmd` a position in `OPCODE_INDEX`, and `args[1]` their counts. Counts can be added and subtracted.
+    """
+    def __init__(self, commands=None, args=None):
+        self.commands = numpy.zeros((len(OPCODE_INDEX),) * 2, dtype=numpy.int64) if commands is None else commands
+        self.args = (numpy.zeros(0, dtype=numpy.int64),) * 2 if args is None else args
+
+    @classmethod
+    def from_scripts(cls, scripts):
+        """
+        Tokenize all of `scripts` once and count their transitions with `numpy.bincount`.
+
+        :param scripts: iterable of `Script` or bytes-like scripts
+        """
+        _, _, pairs, _, keys = _count_tokens(scripts)
+        n = len(OPCODE_INDEX)
+        commands = numpy.bincount(pairs, minlength=n * n).reshape(n, n)
+        # The key space is large and sparsely used, so count over the keys that actually occur
+        keys, inv = numpy.unique(keys, return_inverse=True)
+        return cls(commands, (keys, numpy.bincount(inv, minlength=len(keys))))
 
-    for a1, a2 in zip(script[:cmd._NARGS-1], script[1:cmd._NARGS]):
-        arg_graph.add_edge(a1, a2)
+    @classmethod
+    def per_script(cls, scripts):
+        """
+        As `from_scripts`, but keep the counts of every script separate.
+
+        :return: `list` of `TransitionCounts`, in the order of `scripts`
+        """
+        nscripts, pair_sid, pairs, key_sid, keys = _count_tokens(scripts)
+        n = len(OPCODE_INDEX)
+        commands = numpy.bincount(pair_sid * n * n + pairs, minlength=nscripts * n * n).reshape(nscripts, n, n)
+
+        keys, counts = numpy.unique(key_sid * _ARG_KEYS + keys, return_counts=True)
+        sid, keys = numpy.divmod(keys, _ARG_KEYS)
+        bounds = numpy.searchsorted(sid, numpy.arange(nscripts + 1)).tolist()
+        return [cls(commands[k], (keys[lo:hi], counts[lo:hi]))
+                for k, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))]
 
-class CommandGraph:
+    @classmethod
+    def sum(cls, counts):
+        """
+        Add up any number of `TransitionCounts` at once.
+        """
+        counts = list(counts)
+        if not counts:
+            return cls()
+        keys = numpy.concatenate([c.args[0] for c in counts])
+        weights = numpy.concatenate([c.args[1] for c in counts])
+        keys, inv = numpy.unique(keys, return_inverse=True)
+        total = numpy.bincount(inv, weights=weights, minlength=len(keys)).astype(weights.dtype)
+        nonzero = total != 0
+        return cls(sum(c.commands for c in counts), (keys[nonzero], total[nonzero]))
+
+    @classmethod
+    def from_graph(cls, g):
+        """
+        Counts equivalent to a `CommandGraph`: its transition weights, and every argument edge
+        counted once (their weights are not counts).
+        """
+        transitions = g.transitions if g.transitions is not None else TransitionMatrix.from_graph(g.cmd_graph)
+
+        # Some argument graphs are undirected (e.g. from edit_cmd_arg_graph)
+        keys = [(_OPCODE_POS[cmd] * _ARG_NODES + _arg_index(u)) * _ARG_NODES + _arg_index(v)
+                for cmd, arg_g in g.cmd_arg_graphs.items()
+                for u, v in (arg_g if arg_g.is_directed() else arg_g.to_directed()).edges]
+        keys = numpy.unique(numpy.array(keys, dtype=numpy.int64))
+        return cls(transitions.weights.copy(), (keys, numpy.ones(len(keys), dtype=numpy.int64)))
+
+    def __add__(self, other):
+        return TransitionCounts.sum([self, other])
+
+    def __mul__(self, scale):
+        return TransitionCounts(self.commands * scale, (self.args[0], self.args[1] * scale))
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return TransitionCounts(-self.commands, (self.args[0], -self.args[1]))
+
+    def __sub__(self, other):
+        return TransitionCounts.sum([self, -other])
+
+    def arg_edges(self):
+        """
+        Iterate over the argument edges as (command, u, v, count), in key order.
+        """
+        keys, counts = self.args
+        cmds, rest = numpy.divmod(keys, _ARG_NODES**2)
+        us, vs = numpy.divmod(rest, _ARG_NODES)
+        for cmd, u, v, c in zip(cmds.tolist(), us.tolist(), vs.tolist(), counts.tolist()):
+            yield OPCODE_INDEX[cmd], _arg_node(u), _arg_node(v), c
+
+class GenerationMetrics:
+    """
+    Counters from script generation, to see where the generation time goes: the aborts and rejections by
+    reason, how many commands were drawn and kept, and how many attempts every script took. Pass one to
+    the generation methods as `metrics`, they add to it. Metrics add up with `+=`, e.g. over an area.
+    """
     def __init__(self):
+        # Aborted attempts and rejected tokens, keyed like "rule/targeting_rules"
+        self.aborts = Counter()
+        self.samples = 0
+        self.accepted = 0
+        # Attempts taken by each generated script
+        self.attempts = []
+
+    def __iadd__(self, other):
+        self.aborts.update(other.aborts)
+        self.samples += other.samples
+        self.accepted += other.accepted
+        self.attempts += other.attempts
+        return self
+
+    def to_dict(self):
+        """
+        The metrics as a JSON serializable `dict`.
+        """
+        return {
+            "scripts": len(self.attempts),
+            "samples": self.samples,
+            "accepted": self.accepted,
+            "attempts": {"total": sum(self.attempts), "max": max(self.attempts, default=0),
+                         "per_script": self.attempts},
+            "aborts": dict(self.aborts.most_common()),
+        }
+
+class CommandGraph:
+    # Whether generate_from_graph guarantees a valid script, so callers can skip Script.validate
+    VALIDATES_OUTPUT = False
+
+    def __init__(self, backend="networkx"):
+        """
+        :param backend: `str` storage for the command transitions, either "networkx" (a `networkx.DiGraph`)
+            or "dense" (a `TransitionMatrix`, which is faster to generate from)
+        """
+        if backend not in {"networkx", "dense"}:
+            raise ValueError(f"Unknown command graph backend {backend}")
+        self.backend = backend
+        self.transitions = TransitionMatrix() if backend == "dense" else None
+        self._cmd_graph = networkx.DiGraph() if backend == "networkx" else None
         # NOTE: we can add arbitrary attributes at the graph level here
-        self.cmd_graph = networkx.DiGraph()
         self.cmd_arg_graphs = {cmd: networkx.DiGraph() for cmd in SYNTAX}
+        # Compiled argument graphs, see arg_sampler
+        self._arg_samplers = {}
+        # Preprocessed graphs for generate_from_graph, see generation_graph
+        self._gen_graphs = {}
 
         self.OUT_OF_SYNTAX = []
 
-    def __add__(self, other, augment={}):
-        self_weights = {(u, v): d for u, v, d in self.cmd_graph.edges(data=True)}
-
-        # Compose together the two command graphs
-        self.cmd_graph = networkx.compose(self.cmd_graph, other.cmd_graph)
-
-        # Update weights on connections
-        #for (u, v, c) in G.edges.data('color', default='red')
-        for u, v, d in self.cmd_graph.edges(data=True):
-            if not d and self_weights.get((u, v), None):
-                d.update(self_weights[(u, v)])
-            if other.cmd_graph.has_edge(u, v):
-                d["weight"] += other.cmd_graph.get_edge_data(u, v).get("weight", 1)
+    @property
+    def cmd_graph(self):
+        """
+        Command transitions as a `networkx.DiGraph`. With the dense backend this is a view built on
+        demand, so edits have to be assigned back to take effect.
+        """
+        if self.transitions is not None:
+            return self.transitions.graph
+        return self._cmd_graph
+
+    @cmd_graph.setter
+    def cmd_graph(self, g):
+        if self.transitions is not None:
+            self.transitions = TransitionMatrix.from_graph(g)
+        else:
+            self._cmd_graph = g
+
+    def arg_sampler(self, cmd, allowed=None):
+        """
+        The argument graph of `cmd` compiled into an `ArgGraphSampler`. This is cached, and compiled again
+        if the graph is replaced. Edits made in place need a call to `invalidate_arg_samplers`.
+
+        :param allowed: optional `set` of the argument values to draw from, see `Rule.constrain`
+        """
+        arg_g = self.cmd_arg_graphs[cmd]
+        # Going back to the command itself is always possible
+        key = cmd if allowed is None else (cmd, frozenset(allowed) | {cmd})
+        cached = self._arg_samplers.get(key)
+        if cached is None or cached[0] is not arg_g:
+            cached = self._arg_samplers[key] = (arg_g, ArgGraphSampler(arg_g, None if allowed is None else key[1]))
+        return cached[1]
+
+    def invalidate_arg_samplers(self):
+        self._arg_samplers.clear()
 
-        # Compose argument graphs
-        self.cmd_arg_graphs = {key: networkx.compose(
-            self.cmd_arg_graphs.get(key, networkx.Digraph()),
-            other.cmd_arg_graphs.get(key, networkx.Digraph()))
-            for key in set(self.cmd_arg_graphs) | set(other.cmd_arg_graphs)}
+    def __add__(self, other, augment={}):
+        """
+        Merge with `other` (see `merge`), and compose argument graphs from `augment` into the result.
+        """
+        g = self.merge(self, other, backend=self.backend)
 
         # Compose with augments
-        self.cmd_arg_graphs = {key: networkx.compose(
-            self.cmd_arg_graphs.get(key, networkx.Digraph()),
-            augment.get(key, networkx.Digraph()))
-            for key in set(self.cmd_arg_graphs) | set(augment)}
+        for key, aug in augment.items():
+            g.cmd_arg_graphs[key] = _arg_graph_edited(networkx.compose(g.cmd_arg_graphs.get(key, networkx.DiGraph()),
+                                                                       aug))
+
+        return g
 
     def to_text_repr(self, suppress_args=True):
         tstr = ""
@@ -106,10 +720,21 @@ class CommandGraph:
         return tstr
 
     @classmethod
-    def merge(cls, *graphs):
-        g = graphs.pop(0) if graphs else CommandGraph()
-        for other in graphs:
-            g += other
+    def merge(cls, *graphs, scales=None, backend=None):
+        """
+        Merge any number of graphs at once. The command transition weights are added up, and the argument
+        graphs are joined. This is done in a single pass over their `TransitionCounts`.
+
+        :param scales: optional `list` of factors, one per graph, to scale its transition weights with
+        :param backend: of the merged graph, by default that of the first graph
+        :return: a new graph, laid out as `from_scripts` would build it (argument edges are unweighted)
+        """
+        counts = [TransitionCounts.from_graph(g) for g in graphs]
+        if scales is not None:
+            counts = [c * scale for c, scale in zip(counts, scales, strict=True)]
+
+        g = cls(backend=backend or (graphs[0].backend if graphs else "networkx"))
+        g.add_counts(TransitionCounts.sum(counts))
         return g
 
     def visualize(self, fname=None):
@@ -159,56 +784,50 @@ class CommandGraph:
         return fig
 
     def from_scripts(self, scripts, on_parse_error='raise'):
-        for name, script in list(scripts.items()):
-            self.from_script(script)
-
-            # FIXME: can we delete this?
-            if len(self.OUT_OF_SYNTAX) > 0 and on_parse_error is not None:
-                v = self.OUT_OF_SYNTAX[-1]
-                # FIXME: names seem wrong
-                print(f"{name} | Unconsumed byte(s), last [{hex(v)}] corresponding skill: {flags.SPELL_LIST[v]}.\n"
-                      f"Script: {script}\n")
-                #f"Script so far: {', '.join(map(hex, _script[1:]))}")
-                print(self.OUT_OF_SYNTAX)
-                #translate(_cpy)
-                if on_parse_error == "raise":
-                    raise ValueError(f"Unconsumed byte {hex(v)}.")
+        """
+        Add the transitions of all of `scripts` (a `dict` of name -> script) to the graph.
+        """
+        self.add_counts(TransitionCounts.from_scripts(scripts.values()))
+
+        # FIXME: can we delete this?
+        if len(self.OUT_OF_SYNTAX) > 0 and on_parse_error is not None:
+            v = self.OUT_OF_SYNTAX[-1]
+            print(f"Unconsumed byte(s), last [{hex(v)}] corresponding skill: {flags.SPELL_LIST[v]}.\n")
+            print(self.OUT_OF_SYNTAX)
+            if on_parse_error == "raise":
+                raise ValueError(f"Unconsumed byte {hex(v)}.")
 
     def from_script(self, script):
-        script = [*script]
-        cpy = " ".join([hex(s) for s in script])
-        _cpy = bytearray(script)
-
-        #
-        # construct the exp-tree
-        #
-        # beginning marker
-        last_cmd = "^"
-
-        # preprocessing:
-        while len(script) > 0:
-            v = script.pop(0)
-
-            if v not in syntax.Cmd._CMD_REG:
-                # assume skill command
-                script = ["_", v] + script
-                continue
-            cmd = syntax.Cmd._CMD_REG[v]
-
-            v = "^" if cmd == "^" else cmd._BYTEVAL
-            self.cmd_graph.add_node(v, type="command", nbytes=cmd._NARGS, descr=cmd._DESCR)
-            self.cmd_graph.add_edge(last_cmd, v)
-            self.cmd_graph.get_edge_data(last_cmd, v)["weight"] = \
-                self.cmd_graph.get_edge_data(last_cmd, v).get("weight", 0) + 1
-            last_cmd = v
-
-            if cmd._NARGS is not None and cmd._NARGS > 0:
-                # FIXME: handle this at init
-                self.cmd_arg_graphs[v].add_node(v, type="command", nbytes=cmd._NARGS, descr=cmd._DESCR)
-                self.cmd_arg_graphs[v].add_edge(v, script[0])
-
-                _bind_token(cmd, script, self.cmd_arg_graphs[v])
-                script = script[cmd._NARGS:]
+        self.add_counts(TransitionCounts.from_scripts([script]))
+
+    def add_counts(self, counts):
+        """
+        Add transition counts (see `TransitionCounts`) to the command and argument graphs.
+        """
+        if self.transitions is not None:
+            self.transitions.add_weights(counts.commands)
+        else:
+            g = self.cmd_graph
+            for i, j in zip(*numpy.nonzero(counts.commands)):
+                u, v = OPCODE_INDEX[i], OPCODE_INDEX[j]
+                for node in (u, v):
+                    if node in syntax.Cmd._CMD_REG and node not in g:
+                        cmd = syntax.Cmd._CMD_REG[node]
+                        g.add_node(node, type="command", nbytes=cmd._NARGS, descr=cmd._DESCR)
+                weight = counts.commands[i, j].item()
+                weight = int(weight) if float(weight).is_integer() else weight
+                g.add_edge(u, v, weight=g.get_edge_data(u, v, {}).get("weight", 0) + weight)
+
+        # Argument graphs keep their edges unweighted, regulate_difficulty sets the weights
+        for v, a1, a2, _ in counts.arg_edges():
+            cmd, arg_g = syntax.Cmd._CMD_REG[v], self.cmd_arg_graphs[v]
+            for arg in {a1, a2} - {v}:
+                if arg not in arg_g:
+                    arg_g.add_node(arg, type="generic", descr=cmd.parse_args([arg])[0][1])
+            arg_g.add_node(v, type="command", nbytes=cmd._NARGS, descr=cmd._DESCR)
+            arg_g.add_edge(a1, a2)
+            _arg_graph_edited(arg_g)
+        self.invalidate_arg_samplers()
 
     def validate(self):
         # All graph nodes should be reachable from start
@@ -223,13 +842,31 @@ class CommandGraph:
         for node in self.cmd_graph.nodes:
             assert len(self.cmd_graph[node]) != 0, node
 
-    def generate_from_graph(self, start_cmd="^",
-                            main_block_len=None, main_block_avg=2, allow_empty_main_blocks=False,
-                            disallow_commands=set(), weighted=True, naborts=20, strict=True):
-        import numpy
-        script = []
-
-        # Make a copy, because we can modify the graph in flight
+    def _graph_version(self):
+        """
+        Something that changes whenever the command transitions do. `networkx` graphs do not count their
+        edits, but the command graph is small enough to just compare its nodes and weighted edges.
+        """
+        if self.transitions is not None:
+            return self.transitions, self.transitions.version
+        g = self._cmd_graph
+        return g, (frozenset(g.nodes), frozenset((u, v, d.get("weight", 1)) for u, v, d in g.edges(data=True)))
+
+    def generation_graph(self, start_cmd="^", disallow_commands=set()):
+        """
+        The command graph as prepared for `generate_from_graph`. This is memoized per `start_cmd` and
+        `disallow_commands`, and prepared again once the command graph changes. The result is shared
+        between calls, so it must not be modified.
+        """
+        key = (start_cmd, frozenset(disallow_commands))
+        src, version = self._graph_version()
+        cached = self._gen_graphs.get(key)
+        if cached is None or cached[0] is not src or cached[1] != version:
+            cached = self._gen_graphs[key] = (src, version, self._prepare_generation_graph(start_cmd, disallow_commands))
+        return cached[2]
+
+    def _prepare_generation_graph(self, start_cmd, disallow_commands):
+        # Make a copy, because we modify the graph below
         g = self.cmd_graph.copy()
 
         # Handle disallowed commands
@@ -247,9 +884,20 @@ class CommandGraph:
                 if cmd in g[start_cmd]:
                     g.remove_edge(start_cmd, cmd)
                 # This contracts for only this node, and it's a permanent change for this run through
-                #print(self.cmd_graph.edges)
                 g = networkx.algorithms.minors.contracted_nodes(g, gptr, cmd)
-                #print(gptr, cmd, g.edges)
+
+        return g
+
+    def generate_from_graph(self, start_cmd="^",
+                            main_block_len=None, main_block_avg=2, allow_empty_main_blocks=False,
+                            disallow_commands=set(), weighted=True, naborts=20, strict=True, metrics=None):
+        """
+        :param metrics: optional `GenerationMetrics` to add the counters of this run to
+        """
+        import numpy
+        script = []
+
+        g = self.generation_graph(start_cmd, disallow_commands)
 
         # We also have to break a potential link between 0xFC and 0xF{E,F} so we don't try and create
         # empty FC blocks
@@ -277,8 +925,8 @@ class CommandGraph:
         # Adjust the allowed number of aborts for longer scripts
         naborts *= main_block_len
 
-        from collections import defaultdict
         aborts = defaultdict(lambda: 0)
+        nsamples, naccepted = 0, 0
         #while nff < 2:
         while nff < 2 and naborts >= 0:
             last = gptr
@@ -311,6 +959,7 @@ class CommandGraph:
                 weights = [w / weights for w in gptr.values()]
             else:
                 weights = [1 / len(gptr)] * len(gptr)
+            nsamples += 1
             try:
                 gptr = numpy.random.choice(list(gptr), p=weights)
             except:
@@ -365,6 +1014,7 @@ class CommandGraph:
                 nff += 1
             elif gptr == 0xFC:
                 nfc += 1
+            naccepted += 1
 
             # catch '_'
             try:
@@ -377,7 +1027,7 @@ class CommandGraph:
             nargs = SYNTAX[gptr][0]
             if gptr in self.cmd_arg_graphs and (nargs or 0) > 0:
                 # append arguments
-                script.extend(expand(self.cmd_arg_graphs[gptr], gptr, nargs))
+                script.extend(expand(self.arg_sampler(gptr), gptr, nargs))
 
             # Track vars in use
             if gptr in {0xF8, 0xF9}:
@@ -395,6 +1045,13 @@ class CommandGraph:
             if gptr in {0xF0, 0xF4, 0xF6, "_"}:
                 ncmd += 1
 
+        if metrics is not None:
+            # Aborts here only resample the token, the script is built in one attempt
+            metrics.aborts.update(aborts)
+            metrics.samples += nsamples
+            metrics.accepted += naccepted
+            metrics.attempts.append(1)
+
         if not (nff == 2 and naborts >= 0):
             exit("Failed to generate script within the prescribe number of attempts. "
                  "Exiting to avoid potential infinite loops")
@@ -408,16 +1065,34 @@ class CommandGraph:
         # end marker
         script.append("$")
 
+        # Bare skills are redrawn from the skill argument graphs, so that their weights (e.g. from
+        # regulate_difficulty) apply. Command bytes can't stand in for a skill, so they are left out.
+        skill_samplers = []
+        for cmd in ("_", 0xF0):
+            if cmd not in self.cmd_arg_graphs:
+                continue
+            skills = {s for s in self.cmd_arg_graphs[cmd] if s not in syntax.Cmd._CMD_REG}
+            sampler = self.arg_sampler(cmd, skills)
+            if skills and any(v != cmd for v in sampler.neighbors(cmd)):
+                skill_samplers.append((len(skills), cmd, sampler))
+        nskills = sum(n for n, _, _ in skill_samplers)
+
         # preprocessing:
         while script[0] != "$":
             v = script.pop(0)
 
             if v not in SYNTAX:
                 # assume skill command
-                skills = list(self.cmd_arg_graphs.get(0xF0, [0xF0, 0xEE]))[1:]
-                skills += list(self.cmd_arg_graphs.get("_", ["_"]))[1:]
-                skills = [s for s in skills if s not in syntax.Cmd._CMD_REG]
-                script.append(random.choice(skills))
+                if not skill_samplers:
+                    script.append(0xEE)
+                    continue
+                # Pick a graph in proportion to the skills it has, as if they were pooled
+                u = RNG_POOL.random() * nskills
+                for n, cmd, sampler in skill_samplers:
+                    if u < n:
+                        break
+                    u -= n
+                script.extend(expand(sampler, cmd, nargs=1))
                 continue
 
             nbytes, _, descr = SYNTAX[v]
@@ -427,7 +1102,7 @@ class CommandGraph:
 
             if v not in required and nbytes > 0:
                 # generate new arguments
-                args = expand(self.cmd_arg_graphs[v], v, nbytes)
+                args = expand(self.arg_sampler(v), v, nbytes)
 
             # Drop certain events
             if v == 0xF7 and args[0] in drop_events:
@@ -439,6 +1114,47 @@ class CommandGraph:
         return script[1:]
 
 
+class PoolCounts:
+    """
+    Transition counts for many, mostly overlapping, pools of scripts from the same ROM, such as
+    the sliding window over the areas in `__main__`.
+
+    Every script is counted once. The counts of a pool are derived from those of the previous pool
+    by adding and subtracting the scripts that differ, and pools seen before are memoized.
+    """
+    def __init__(self):
+        self._scripts = {}
+        self._pools = {}
+        self._last = (frozenset(), TransitionCounts())
+
+    def counts(self, scripts):
+        """
+        :param scripts: `dict` of name -> script. Scripts are identified by name only.
+        :return: `TransitionCounts` of all of `scripts`
+        """
+        names = frozenset(scripts)
+        if names not in self._pools:
+            new = [name for name in scripts if name not in self._scripts]
+            self._scripts.update(zip(new, TransitionCounts.per_script([scripts[name] for name in new])))
+
+            last, counts = self._last
+            # Start from scratch if that is less work
+            if len(names ^ last) > len(names):
+                last, counts = frozenset(), TransitionCounts()
+            self._pools[names] = TransitionCounts.sum([counts, *[self._scripts[name] for name in names - last],
+                                                      *[-self._scripts[name] for name in last - names]])
+
+        self._last = (names, self._pools[names])
+        return self._pools[names]
+
+    def graph(self, scripts, backend="networkx"):
+        """
+        A new `CommandGraph` for `scripts`, the same as `from_scripts` would build.
+        """
+        g = CommandGraph(backend=backend)
+        g.add_counts(self.counts(scripts))
+        return g
+
 def edit_cmd_arg_graph(cmd_graph, drop_skills={}, drop_nothing=False,
                        add_cmds=None):
     # remove "Nothing" from CHOOSE SPELL
@@ -457,6 +1173,9 @@ def edit_cmd_arg_graph(cmd_graph, drop_skills={}, drop_nothing=False,
             # Targeting nodes without any outgoing edges, so instead of dropping
             # the command node, we just add "Nothing" as the only possible argument
             subgraph.add_edge(cmd, 0xFE, weight=1)
+        _arg_graph_edited(subgraph)
+    # The graphs above were edited in place
+    cmd_graph.invalidate_arg_samplers()
 
     # FIXME: sanitize and expand this
     link_nodes = set(cmd_graph.cmd_graph.nodes) - {"^", 0xFE, 0xFF}
@@ -465,80 +1184,257 @@ def edit_cmd_arg_graph(cmd_graph, drop_skills={}, drop_nothing=False,
         # method for the command
         n1 = random.choice(list(link_nodes))
         n2 = random.choice(list(link_nodes))
-        networkx.add_path(cmd_graph.cmd_graph, (n1, 0xF4, n2), weight=1)
+        g = cmd_graph.cmd_graph
+        networkx.add_path(g, (n1, 0xF4, n2), weight=1)
+        # Needed for the dense backend, where the graph is a copy
+        cmd_graph.cmd_graph = g
 
         cmd_graph.cmd_arg_graphs[0xF4] = networkx.complete_graph([0xF4] + list(add_cmds))
 
+def _run_steps(steps, sample):
+    """
+    Run a generation loop (see `RestrictedCommandGraph._generation_steps`) to the end, drawing
+    the commands it asks for with `sample(gptr, phase)`.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                gptr = sample(*request)
+            except KeyError as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(gptr)
+    except StopIteration as stop:
+        return stop.value
+
 class RestrictedCommandGraph(CommandGraph):
+    # Generated scripts are checked token by token (see StreamingValidator)
+    VALIDATES_OUTPUT = True
+
     @classmethod
     def get_rule_set(cls, *rules, graph=None):
-        newg = cls()
+        newg = cls(backend=graph.backend if graph else "networkx")
         # process rules
         from .scripting import _RULES
         newg.rule_set = {rule: _RULES[rule]()
                             for rule in set(rules) & set(_RULES)}
 
         if graph:
-            newg.cmd_graph = graph.cmd_graph
-            newg.cmd_arg_graphs = graph.cmd_arg_graphs
+            # Share, rather than copy, the transitions
+            newg.transitions, newg._cmd_graph = graph.transitions, graph._cmd_graph
+            newg.cmd_arg_graphs, newg._arg_samplers = graph.cmd_arg_graphs, graph._arg_samplers
 
         return newg
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, backend="networkx"):
+        super().__init__(backend=backend)
         self.rule_set = {}
+        self._rule_masks = {}
 
     def check_rules(self, script, **ctx):
         return {name for name, rule in self.rule_set.items()
                     if rule(script, **ctx)}
 
+    def invalidate_arg_samplers(self):
+        super().invalidate_arg_samplers()
+        # The masks depend on which arguments can be drawn
+        self._rule_masks.clear()
+
+    def rule_mask(self, last, last_args, context):
+        """
+        Combine what the rules allow after `last` into something the samplers can use directly (see
+        `Rule.constrain`), so that rule breaking tokens are not drawn in the first place.
+
+        :param last: `syntax.Cmd` subclass of the last token of the script, None at its start
+        :param last_args: `list` of the arguments of `last`
+        :return: (`frozenset` of commands which may not follow, `dict` of command -> `frozenset` of allowed arguments)
+        """
+        key = (last, tuple(last_args), context["phase"], context["nfc"])
+        if key in self._rule_masks:
+            return self._rule_masks[key]
+
+        forbidden, arg_sets = set(), {}
+        for rule in self.rule_set.values():
+            for cmd, allowed in rule.constrain(last, last_args, **context).items():
+                if allowed is None:
+                    forbidden.add(cmd)
+                else:
+                    arg_sets[cmd] = arg_sets.get(cmd, allowed) & allowed
+
+        # Commands whose arguments cannot be drawn within what is allowed are out too
+        for cmd, allowed in arg_sets.items():
+            if cmd in forbidden or cmd not in self.cmd_arg_graphs or not SYNTAX[cmd][0]:
+                continue
+            # Don't draw to find out, the masks are cached so that would make the draws depend on the cache
+            if not self.arg_sampler(cmd, allowed).has_choices(cmd):
+                forbidden.add(cmd)
+
+        mask = self._rule_masks[key] = (frozenset(forbidden),
+                                        {cmd: frozenset(allowed) for cmd, allowed in arg_sets.items()
+                                                                 if cmd not in forbidden})
+        return mask
+
+    def _prepare_generation_graph(self, start_cmd, disallow_commands):
+        if self.transitions is not None:
+            # Same as below, but on the dense matrix
+            g = self.transitions.for_generation(start_cmd, disallow_commands)
+        else:
+            # Make a copy, because we modify the graph below
+            g = self.cmd_graph.copy()
+
+            # Nullify the outgoing links to block enders
+            # NOTE: we don't remove incoming links because they're needed for generation
+            g.remove_edges_from([(u, v) for u, v in g.edges if v in {0xFE, 0xFF}])
+            # replace some of them with links to "^", e.g. in the case they become terminal
+            for node in g.nodes:
+                if len(g[node]) == 0:
+                    g.add_edge(node, "^")
+
+            # TODO: replace these with rule sets
+            # Handle disallowed commands
+            # Basically, we're 'contracting' the graph by allowing the jump to 'skip'
+            # over the disallowed command, while preserving the ability to jump to
+            # outgoing connections of the disallowed node itself
+            for gptr in set(g.nodes) - disallow_commands:
+                for cmd in set(g[gptr]) & disallow_commands:
+                    # The contraction process, by default, changes edges between u and v into self loops
+                    # on the linked node. While it's not fatal to have this behavior, to keep things
+                    # a bit cleaner, we'll ensure the link to the start char is broken before the contraction
+                    # so that no self-loops on the start cmd happen
+                    if start_cmd in g[cmd]:
+                        g.remove_edge(cmd, start_cmd)
+                    if cmd in g[start_cmd]:
+                        g.remove_edge(start_cmd, cmd)
+                    # This contracts for only this node, and it's a permanent change for this run through
+                    g = networkx.algorithms.minors.contracted_nodes(g, gptr, cmd)
+
+        return g
+
     # rewrite of generate_from_graph
     def generate_from_graph(self, start_cmd="^",
                             main_block_len=None, main_block_avg=2, allow_empty_main_blocks=False,
                             cntr_block_len=None, cntr_block_avg=1, allow_empty_cntr_blocks=True,
-                            disallow_commands=set(), weighted=True, naborts=20):
-
-        main_block_avg = None if main_block_avg is None else numpy.random.poisson(main_block_avg)
+                            disallow_commands=set(), weighted=True, naborts=20, metrics=None):
+        """
+        :param metrics: optional `GenerationMetrics` to add the counters of this run to
+        """
+        main_block_len, cntr_block_len = self._block_lengths(main_block_len, main_block_avg, allow_empty_main_blocks,
+                                                             cntr_block_len, cntr_block_avg, allow_empty_cntr_blocks)
+        g = self.generation_graph(start_cmd, disallow_commands)
+
+        steps = self._generation_steps(start_cmd, main_block_len, cntr_block_len, weighted, naborts,
+                                       metrics=metrics)
+        return _run_steps(steps, lambda gptr, phase, exclude:
+                                    self.generate_script_token(g, gptr, script_context=phase, exclude=exclude))
+
+    def generate_batch(self, n=None, seeds=None, seed=None, start_cmd="^",
+                       main_block_len=None, main_block_avg=2, allow_empty_main_blocks=False,
+                       cntr_block_len=None, cntr_block_avg=1, allow_empty_cntr_blocks=True,
+                       disallow_commands=set(), weighted=True, naborts=20, metrics=None):
+        """
+        Generate several scripts at once, with the same options as `generate_from_graph`. The scripts are
+        advanced in lockstep: at every step, the next command of all unfinished scripts is drawn in one
+        vectorized operation (see `TransitionMatrix.sample_many`).
+
+        Every script draws from its own random stream, so it only depends on its seed and not on
+        the rest of the batch, nor on whatever was generated before:
+
+        >>> scripts = {"Guard": bytes([0x00, 0xFF, 0xFC, 0x01, 0x00, 0x00, 0x01, 0xFF]),
+        ...            "Rhodox": bytes([0xF1, 0x36, 0x02, 0xFD, 0x00, 0xFF, 0xFF])}
+        >>> seeds = numpy.random.SeedSequence(0).spawn(6)
+        >>> for backend in ("networkx", "dense"):
+        ...     g = CommandGraph(backend=backend)
+        ...     g.from_scripts(scripts)
+        ...     g = RestrictedCommandGraph.get_rule_set("no_empty_cond_block", "targeting_rules", graph=g)
+        ...     batch = g.generate_batch(seeds=seeds)
+        ...     _ = g.generate_from_graph()
+        ...     print(g.generate_batch(seeds=seeds[3:4]) == batch[3:4],
+        ...           g.generate_batch(seeds=seeds[1:4]) == batch[1:4])
+        True True
+        True True
+
+        :param n: `int` number of scripts, their streams are spawned from `seed`
+        :param seeds: `list` of seeds, one script for each. Use this to e.g. generate an area for several seeds at once.
+        :param seed: seed to spawn the `n` streams from, if None it is drawn from `numpy.random`
+        :return: `list` of scripts, as `generate_from_graph` returns them
+        """
+        if seeds is None:
+            seed = numpy.random.randint(2**32) if seed is None else seed
+            seeds = numpy.random.SeedSequence(seed).spawn(n)
+        pools = [RandomPool(s, block_size=256) for s in seeds]
+
+        g = self.generation_graph(start_cmd, disallow_commands)
+        tmat = g if isinstance(g, TransitionMatrix) else TransitionMatrix.from_graph(g)
+
+        runs, requests = [], []
+        for pool in pools:
+            lengths = self._block_lengths(main_block_len, main_block_avg, allow_empty_main_blocks,
+                                          cntr_block_len, cntr_block_avg, allow_empty_cntr_blocks,
+                                          poisson=pool.poisson)
+            runs.append(self._generation_steps(start_cmd, *lengths, weighted, naborts, rng=pool, metrics=metrics))
+            requests.append(None)
+
+        scripts = [None] * len(runs)
+        done = numpy.zeros(len(runs), dtype=bool)
+
+        def advance(i, step, *args):
+            try:
+                requests[i] = step(*args)
+            except StopIteration as stop:
+                scripts[i], done[i] = stop.value, True
+
+        for i, run in enumerate(runs):
+            advance(i, next, run)
+
+        while not done.all():
+            active = numpy.flatnonzero(~done)
+            u = numpy.fromiter((pools[i].random() for i in active), dtype=float, count=len(active))
+            nxt = tmat.sample_many([requests[i][0] for i in active], u, weighted=weighted,
+                                   excludes=[requests[i][2] for i in active])
+            for i, gptr in zip(active, nxt):
+                if gptr is None:
+                    advance(i, runs[i].throw, KeyError(f"{requests[i][0]} has no valid choices"))
+                else:
+                    advance(i, runs[i].send, gptr)
+
+        return scripts
+
+    @staticmethod
+    def _block_lengths(main_block_len, main_block_avg, allow_empty_main_blocks,
+                       cntr_block_len, cntr_block_avg, allow_empty_cntr_blocks, poisson=None):
+        poisson = poisson or numpy.random.poisson
+
+        main_block_avg = None if main_block_avg is None else poisson(main_block_avg)
         main_block_len = main_block_len or main_block_avg
         if not allow_empty_main_blocks and main_block_len == 0:
             main_block_len = 1
 
-        cntr_block_avg = None if cntr_block_avg is None else numpy.random.poisson(cntr_block_avg)
+        cntr_block_avg = None if cntr_block_avg is None else poisson(cntr_block_avg)
         cntr_block_len = cntr_block_len or cntr_block_avg
         if not allow_empty_cntr_blocks and cntr_block_len == 0:
             cntr_block_len = 1
 
-        # Make a copy, because we can modify the graph in flight
-        g = self.cmd_graph.copy()
+        return main_block_len, cntr_block_len
 
-        # Nullify the outgoing links to block enders
-        # NOTE: we don't remove incoming links because they're needed for generation
-        g.remove_edges_from([(u, v) for u, v in g.edges if v in {0xFE, 0xFF}])
-        # replace some of them with links to "^", e.g. in the case they become terminal
-        for node in g.nodes:
-            if len(g[node]) == 0:
-                g.add_edge(node, "^")
+    def _generation_steps(self, start_cmd, main_block_len, cntr_block_len, weighted, naborts, rng=None,
+                          metrics=None):
+        """
+        The generation loop of `generate_from_graph`, written as a generator so that several scripts can be
+        advanced together. Whenever it needs the next command, it yields (current command, block phase,
+        commands the rules forbid) and expects the drawn command to be sent back, or a `KeyError` thrown
+        in if there is none. The finished script is the return value.
 
-        # TODO: replace these with rule sets
-        # Handle disallowed commands
-        # Basically, we're 'contracting' the graph by allowing the jump to 'skip'
-        # over the disallowed command, while preserving the ability to jump to
-        # outgoing connections of the disallowed node itself
-        for gptr in set(g.nodes) - disallow_commands:
-            for cmd in set(g[gptr]) & disallow_commands:
-                # The contraction process, by default, changes edges between u and v into self loops
-                # on the linked node. While it's not fatal to have this behavior, to keep things
-                # a bit cleaner, we'll ensure the link to the start char is broken before the contraction
-                # so that no self-loops on the start cmd happen
-                if start_cmd in g[cmd]:
-                    g.remove_edge(cmd, start_cmd)
-                if cmd in g[start_cmd]:
-                    g.remove_edge(start_cmd, cmd)
-                # This contracts for only this node, and it's a permanent change for this run through
-                g = networkx.algorithms.minors.contracted_nodes(g, gptr, cmd)
+        :param rng: `RandomPool` for the other random choices (arguments, ending conditionals), the
+            module's random generators are used if None
+        :param metrics: optional `GenerationMetrics` to add the counters of this run to
+        """
+        randint = random.randint if rng is None else rng.randint
 
         aborts = defaultdict(lambda: 0)
+        nsamples, naccepted, nattempts = 0, 0, 0
         while naborts >= 0:
+            nattempts += 1
             context = {
                 "phase": "main",
                 "weighted": weighted,
@@ -549,14 +1445,29 @@ class RestrictedCommandGraph(CommandGraph):
                 "rule_checks": 100
             }
             script, gptr = [], start_cmd
-            _script = []
-            scr_len = 0
+            # Counted commands, and modifiers (targeting, conditionals, waits) since the last of them
+            scr_len, nmods = 0, 0
+            # Catch syntax errors as the tokens are appended, rather than after the fact
+            validator = StreamingValidator()
+            # What the rules look at, kept up to date as tokens are appended
+            rules = RuleContext()
 
             try:
                 while scr_len < main_block_len + cntr_block_len:
                     last = gptr
+                    prev, prev_args = rules.token_from_end(with_args=True) if len(rules) else (None, [])
+                    forbidden, arg_sets = self.rule_mask(prev, prev_args, context)
                     # TODO: have the current command generate the token
-                    gptr = self.generate_script_token(g, gptr, script_context=context["phase"])
+                    try:
+                        gptr = yield gptr, context["phase"], forbidden
+                    except KeyError:
+                        # The links to the block enders were removed from the graph, so the END FC BLOCKs
+                        # we add below usually have nowhere to go. Carry on from the start, as other
+                        # terminal nodes do, rather than dropping the script.
+                        if gptr != syntax.EndPredBlock._BYTEVAL:
+                            raise
+                        gptr = yield start_cmd, context["phase"], forbidden
+                    nsamples += 1
 
                     # "Restarting" is allowed, because we replaced block enders earlier
                     if gptr == "^":
@@ -566,13 +1477,13 @@ class RestrictedCommandGraph(CommandGraph):
                     # TODO: formation handling
 
                     # Need we arguments for command?
-                    args = self.generate_cmd_args(gptr, context)
+                    args = self.generate_cmd_args(gptr, context, rng=rng, allowed=arg_sets.get(gptr))
 
                     _gptr = syntax.Cmd._CMD_REG[gptr]
                     #_gptr = syntax.Cmd[gptr]
 
-                    # Check rules
-                    blocking_rules = self.check_rules(_script + [_gptr] + args, **context)
+                    # Check rules, for whatever the masks could not express
+                    blocking_rules = self.check_rules(rules.appended(_gptr, args), **context)
 
                     # Do rule checking or abort if we're encountering too many
                     if context["rule_checks"] <= 0:
@@ -586,43 +1497,53 @@ class RestrictedCommandGraph(CommandGraph):
                         context["rule_checks"] -= 1
                         continue
 
+                    # Likewise, resample if the token would break the script syntax
+                    try:
+                        validator.push(_gptr, args)
+                    except ValueError:
+                        aborts["syntax/invalid_token"] += 1
+                        gptr = last
+                        context["rule_checks"] -= 1
+                        continue
+                    naccepted += 1
+
                     if isinstance(gptr, int):
                         script.extend([gptr] + args)
                     else:
                         # Handle do skill commands
                         script.extend(args)
-                    _script.append(_gptr)
-                    _script.extend(args)
+                    rules.push(_gptr, args)
 
                     # Increasingly likely to end the block
                     # Note that this hardcodes no empty conditionals
-                    if random.randint(0, context["nfc"]) > 0 \
+                    if randint(0, context["nfc"]) > 0 \
                           and _gptr not in {syntax.Targeting, syntax.CmdPred}:
                         _gptr = syntax.EndPredBlock
                         gptr = _gptr._BYTEVAL
-                        _script.append(_gptr)
+                        validator.push(_gptr)
+                        rules.push(_gptr)
                         script.append(gptr)
 
                     # Track number of useable commands
                     # FIXME: change to syntax objects
                     # FIXME: ncmd should be earlier
-                    context["nfc"] += 1 if gptr in {syntax.CmdPred._BYTEVAL} else 0
+                    context["nfc"] = rules.nfc
                     context["ncmd"] += 1 if gptr in {c._BYTEVAL for c in syntax.ATTACK_CMDS} else 0
-                    if gptr == syntax.EndPredBlock._BYTEVAL:
-                        context["nfc"] = 0
 
                     # only increment the command counter if
                     # we're not under influence of modifiers
                     if gptr not in {syntax.Targeting._BYTEVAL, syntax.CmdPred._BYTEVAL,
                                     syntax.Wait._BYTEVAL}:
-                        scr_len += 1
+                        scr_len, nmods = scr_len + 1, 0
+                    else:
+                        nmods += 1
+                    # Modifiers don't advance the script, and with the others masked the graph may only
+                    # lead from one to the next (e.g. WAIT -> WAIT), vanilla scripts have at most two in a row
+                    if nmods > 8:
+                        raise ValueError("Too many modifiers in a row")
 
-                    # conditional handling
-                    # if we're at the end of the block, conditionals can't be closed, retry
-                    if ((context["phase"] == "main" and main_block_len == scr_len) or \
-                        (context["phase"] == "counter" and cntr_block_len == scr_len)) and \
-                            gptr == syntax.CmdPred._BYTEVAL:
-                        raise ValueError("Cannot end block with conditional")
+                    # No need to check for a conditional at the end of a block: blocks are only ended after
+                    # a counted command, so there's always one for it to apply to
 
                     # End the main block if needed
                     # END BLOCK and END FC BLOCK act the same if we are in a conditional
@@ -631,10 +1552,14 @@ class RestrictedCommandGraph(CommandGraph):
                     # appear
                     if context["phase"] == "main" and scr_len == main_block_len:
                         _gptr = syntax.EndBlock
+                        validator.push(_gptr)
                         script.append(_gptr._BYTEVAL)
-                        _script.append(_gptr)
-                        context["nfc"] = 0
-                        context["phase"] = "counter"
+                        rules.push(_gptr)
+                        context["nfc"], context["phase"] = rules.nfc, rules.phase
+
+                # The script terminator is added below, make sure it's allowed here
+                validator.push(syntax.EndBlock)
+                validator.finish()
 
             except KeyError as e:
                 # Bad command graph links
@@ -651,10 +1576,15 @@ class RestrictedCommandGraph(CommandGraph):
             else:
                 # We're done, add script terminator
                 script += [syntax.EndBlock._BYTEVAL]
-                _script += [syntax.EndBlock]
                 # Break out of abort check loop
                 break
 
+        if metrics is not None:
+            metrics.aborts.update(aborts)
+            metrics.samples += nsamples
+            metrics.accepted += naccepted
+            metrics.attempts.append(nattempts)
+
         import pprint
         if not naborts >= 0:
             exit("Failed to generate script within the prescribe number of attempts. "
@@ -665,29 +1595,37 @@ class RestrictedCommandGraph(CommandGraph):
 
         return script
 
-    def generate_script_token(self, g, gptr="^", script_context="main", weighted=True):
+    def generate_script_token(self, g, gptr="^", script_context="main", weighted=True, exclude=None):
         # Things needed for context
         assert script_context in {"main", "counter"}
 
+        # Dense backend, the syntax rules and normalization are already folded in
+        if isinstance(g, TransitionMatrix):
+            return g.sample(gptr, weighted=weighted, exclude=exclude)
+
         if gptr not in g or len(g[gptr]) == 0:
             _gptr = hex(gptr) if isinstance(gptr, int) else gptr
+            # This is caught and retried during generation, so only render the graph if it is logged
+            log.debug("Command graph:%s", Deferred(self.to_text_repr))
             raise KeyError(f"Current command pointer ({_gptr} / {SYNTAX[gptr][-1]}) "
-                           "has no outgoing links. Command graph:\n"
-                           + self.to_text_repr())
+                           "has no outgoing links.")
 
         # Get our outgoing links
         weights = {c: w.get("weight", 1) for c, w in g[gptr].items()}
 
         # prune decisions for unusable syntax
         syntax.apply_syntax_rules(gptr, weights)
+        # and those the rules do not allow
+        for cmd in (exclude or ()):
+            if cmd in weights:
+                weights[cmd] = 0
 
         # TODO: establish workarounds
         norm = sum(weights.values())
         if norm == 0:
+            log.debug("Command graph (%d elements):%s", len(g), Deferred(self.to_text_repr))
             raise KeyError("gptr has no valid choices."
-                           f"\ngptr / weights: {gptr} {weights}"
-                           f"\ncommand graph ({len(g)} elements):\n"
-                           + self.to_text_repr())
+                           f"\ngptr / weights: {gptr} {weights}")
 
         # If "weighted" is turned on, then we use the appropriately normalized connection weights
         # to assign selection probabilities to each potential next step
@@ -702,12 +1640,15 @@ class RestrictedCommandGraph(CommandGraph):
         gptr = choices[numpy.random.choice(range(len(weights)), p=weights)]
         return gptr
 
-    def generate_cmd_args(self, gptr, context):
+    def generate_cmd_args(self, gptr, context, rng=None, allowed=None):
+        """
+        :param allowed: optional `set` of the argument values to draw from
+        """
         nargs = SYNTAX[gptr][0]
         args = []
         if gptr in self.cmd_arg_graphs and (nargs or 0) > 0:
             # append arguments
-            args = expand(self.cmd_arg_graphs[gptr], gptr, nargs)
+            args = expand(self.arg_sampler(gptr, allowed), gptr, nargs, rng=rng)
 
         # Track vars in use
         # TODO: move to validation
@@ -720,16 +1661,21 @@ class RestrictedCommandGraph(CommandGraph):
             if len(context["vars_in_use"]) == 0:
                 context["vars_in_use"].add(0x0)
             if var not in context["vars_in_use"]:
-                var = numpy.random.choice(list(context["vars_in_use"]))
+                var = (numpy.random if rng is None else rng).choice(list(context["vars_in_use"]))
 
         return args
 
     def regulate_difficulty(self, init_diff=0, trans_diff=0, ranking={}):
+        # Skill ranks by byte value, anything unranked (or below) counts as 1
+        ranks = numpy.ones(0x100)
+        for skill, rank in ranking.items():
+            if isinstance(skill, int) and 0 <= skill < 0x100:
+                ranks[skill] = rank
         # 254 is actually 'Nothing', not Lagomorph
-        ranking[254] = 1
-        # Placeholders, they have a different meaning here
-        ranking[syntax.ChooseSpell._BYTEVAL] = 1
-        ranking[syntax.DoSkill._BYTEVAL] = 1
+        ranks[254] = 1
+        # Placeholder, it has a different meaning here
+        ranks[syntax.ChooseSpell._BYTEVAL] = 1
+        ranks = numpy.maximum(ranks, 1)
 
         # trans_diff = 0 -> 0 --> chaotic AI (all links equal)
         # trans_diff = inf -> 1
@@ -742,25 +1688,39 @@ class RestrictedCommandGraph(CommandGraph):
         init_diff = 2 * (math.erf(init_diff) - 0.5)
 
         # for CHOOSE_SPELL / DO_SKILL
+        changed = False
         for cmd_byte in {syntax.ChooseSpell._BYTEVAL, syntax.DoSkill._BYTEVAL}:
-            if self.cmd_arg_graphs.get(cmd_byte, None) is not None:
-                arg_g = self.cmd_arg_graphs[cmd_byte]
-
-                weights = {n: max(ranking[n], 1) for n in set(arg_g.nodes) - {cmd_byte}}
-                norm = sum([w**init_diff for w in weights.values()])
-                weights = {n: max(mpr, 1)**init_diff / norm for n, mpr in weights.items()}
-                for n in set(arg_g.nodes) - {cmd_byte}:
-                    arg_g.add_edge(cmd_byte, n, weight=weights[n])
-                    #print(flags.SPELL_LIST[n], arg_g.edges[cmd_byte, n]["weight"])
-                    # FIXME: Need a return weight too
-
-                for u, v in arg_g.edges():
-                    if u == cmd_byte or v == cmd_byte:
-                        continue
-                    small, large = max(1, min(ranking[u], ranking[v])), \
-                                   max(max(ranking[u], ranking[v]), 1)
-                    arg_g.edges[u, v]["weight"] = (small / large)**trans_diff
-                    #print(flags.SPELL_LIST[u], flags.SPELL_LIST[v], small, large, arg_g.edges[u, v]["weight"])
+            if self.cmd_arg_graphs.get(cmd_byte, None) is None:
+                continue
+            arg_g = self.cmd_arg_graphs[cmd_byte]
+
+            # Rule sets share their argument graphs, so e.g. every boss of an area asks for the same weights
+            # again. Skip the graph if it was already regulated with these settings, edits to it drop
+            # the mark (see _arg_graph_edited).
+            key = (init_diff, trans_diff, ranks.tobytes())
+            if arg_g.graph.get("regulated") == key:
+                continue
+            changed = True
+
+            nodes = list(set(arg_g.nodes) - {cmd_byte})
+            weights = ranks[nodes]**init_diff
+            weights /= weights.sum()
+            for n, w in zip(nodes, weights.tolist()):
+                arg_g.add_edge(cmd_byte, n, weight=w)
+                # FIXME: Need a return weight too
+
+            edges = [(u, v, d) for u, v, d in arg_g.edges(data=True) if u != cmd_byte and v != cmd_byte]
+            if edges:
+                u, v = ranks[[e[0] for e in edges]], ranks[[e[1] for e in edges]]
+                weights = (numpy.minimum(u, v) / numpy.maximum(u, v))**trans_diff
+                for (_, _, d), w in zip(edges, weights.tolist()):
+                    d["weight"] = w
+
+            arg_g.graph["regulated"] = key
+
+        # The samplers are shared with the other rule sets of the graph, keep them if nothing changed
+        if changed:
+            self.invalidate_arg_samplers()
 
         # TODO: for USE / THROW ITEM
 
@@ -773,6 +1733,7 @@ def _augment_cmd_graph(cmd_graph, statuses=set(), elements=set(), commands=set()
         cmd_graph.cmd_arg_graphs[0xF0] = \
             networkx.algorithms.compose(elem_g,
                                         cmd_graph.cmd_arg_graphs.get(0xF0, networkx.DiGraph()))
+        _arg_graph_edited(cmd_graph.cmd_arg_graphs[0xF0])
 
     for stat in statuses:
         stat_g = STATUS_THEMES[stat].copy()
@@ -780,6 +1741,7 @@ def _augment_cmd_graph(cmd_graph, statuses=set(), elements=set(), commands=set()
         cmd_graph.cmd_arg_graphs[0xF0] = \
             networkx.algorithms.compose(STATUS_THEMES[stat],
                                         cmd_graph.cmd_arg_graphs.get(0xF0, networkx.DiGraph()))
+        _arg_graph_edited(cmd_graph.cmd_arg_graphs[0xF0])
 
     for cmd in commands:
         cmd_g = STATUS_THEMES[cmd].copy()
@@ -787,6 +1749,7 @@ def _augment_cmd_graph(cmd_graph, statuses=set(), elements=set(), commands=set()
         cmd_graph.cmd_arg_graphs[0xF0] = \
             networkx.algorithms.compose(FROM_COMMANDS[cmd],
                                         cmd_graph.cmd_arg_graphs.get(0xF0, networkx.DiGraph()))
+        _arg_graph_edited(cmd_graph.cmd_arg_graphs[0xF0])
 
     return cmd_graph
 
@@ -809,6 +1772,6 @@ def augment_cmd_graph(cmd_graph, status=False, elemental=False, command=False):
     aug_attacks.add_edge(0xF0, list(aug_attacks.nodes)[0])
 
     cmd_graph.cmd_arg_graphs[0xF0] = \
-        networkx.algorithms.compose(aug_attacks, cmd_graph.cmd_arg_graphs[0xF0])
+        _arg_graph_edited(networkx.algorithms.compose(aug_attacks, cmd_graph.cmd_arg_graphs[0xF0]))
 
     return cmd_graph
\ No newline at end of file
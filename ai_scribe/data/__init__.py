@@ -1,17 +1,75 @@
+import numpy
+
+from ..rom import RomBuffer
 
 ENEMY_DATA_OFFSET = 0xF0000
 ENEMY_DATA_SIZE = 0x20
 ENEMY_DATA_BLOCKS = 0x180
 ENEMY_MP_REL_OFFSET = 0x0A
-def give_base_mp(romfile):
+# Layout of a single enemy record, the bytes not listed here are kept as-is
+# https://www.tales-cless.org/ff6hack/#part5
+ENEMY_DTYPE = numpy.dtype({
+    "names": ["speed", "vigor", "hit_rate", "evade", "mblock", "defense", "mdefense", "mpower",
+              "hp", "mp", "exp", "gold", "level"],
+    "formats": ["u1", "u1", "u1", "u1", "u1", "u1", "u1", "u1",
+                "<u2", "<u2", "<u2", "<u2", "u1"],
+    "offsets": [0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7,
+                0x8, ENEMY_MP_REL_OFFSET, 0xC, 0xE, 0x10],
+    "itemsize": ENEMY_DATA_SIZE,
+})
 
-    ptr = ENEMY_DATA_OFFSET + ENEMY_MP_REL_OFFSET
-    for i in range(ENEMY_DATA_BLOCKS):
-        mp = max(20, int.from_bytes(romfile[ptr:ptr + 2], "little"))
-        romfile = romfile[:ptr] + mp.to_bytes(2, "little") + romfile[ptr + 2:]
-        ptr += ENEMY_DATA_SIZE
+class EnemyTable:
+    """
+    Structured view of the enemy data table, one record per enemy.
 
-    return romfile
+    Fields are exposed as arrays over all enemies, so edits can be made in bulk, e.g.
+
+    >>> table = EnemyTable(bytearray(ENEMY_DATA_OFFSET + ENEMY_DATA_BLOCKS * ENEMY_DATA_SIZE))
+    >>> table.mp = numpy.maximum(table.mp, 20)
+    >>> romfile = table.write()
+    >>> int(table[0]["mp"]), romfile[ENEMY_DATA_OFFSET + ENEMY_MP_REL_OFFSET]
+    (20, 20)
+
+    Edits are made on a copy of the table and only reach the ROM when `write` is called.
+    """
+    def __init__(self, romfile, offset=ENEMY_DATA_OFFSET, nblocks=ENEMY_DATA_BLOCKS):
+        object.__setattr__(self, "romfile", RomBuffer.load(romfile))
+        object.__setattr__(self, "offset", offset)
+        # Keep the raw bytes around and view them as records, copying the structured array
+        # directly would not preserve the bytes between the known fields
+        data = self.romfile[offset:offset + nblocks * ENEMY_DATA_SIZE]
+        object.__setattr__(self, "_raw", numpy.frombuffer(data, dtype=numpy.uint8).copy())
+        object.__setattr__(self, "records", self._raw.view(ENEMY_DTYPE))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        return self.records[idx]
+
+    def __getattr__(self, name):
+        if name in ENEMY_DTYPE.names:
+            return self.records[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name not in ENEMY_DTYPE.names:
+            raise AttributeError(f"{name} is not a known field of the enemy data")
+        self.records[name] = value
+
+    def write(self):
+        """
+        Copy the (possibly modified) table back into the ROM in one write.
+
+        :return: the `RomBuffer` written to
+        """
+        self.romfile.write(self.offset, self._raw.tobytes(), descr="enemy data")
+        return self.romfile
+
+def give_base_mp(romfile):
+    table = EnemyTable(romfile)
+    table.mp = numpy.maximum(table.mp, 20)
+    return table.write()
 
 _ESPER_TARGET_PATCH_LEN = 18
 _HIROM_MEM_OFFSET = 0xC00000
@@ -32,10 +90,12 @@ def apply_esper_target_patch(romfile, patch_dst=0xF8700):
     # would have to change to little-endian JSL command 22 9A 78 EF.
     # C2/5905: 22 00 20 F0            JSL Freespace            [Tested at C0D620, BC Code goes to F07000ish]
     #          EA EA                  NOPx2
+    romfile = RomBuffer.load(romfile)
+
     patch_dst_ptr = patch_dst + _HIROM_MEM_OFFSET
     jsl_patch_data = [0x22] + list(patch_dst_ptr.to_bytes(3, "little")) + [0xEA, 0xEA]
 
-    romfile = romfile[:0x25905] + bytes(jsl_patch_data) + romfile[0x25905 + len(jsl_patch_data):]
+    romfile.write(0x25905, jsl_patch_data, descr="esper target patch (JSL)")
 
     # F0/7000:
     patch_data = [
@@ -64,7 +124,7 @@ def apply_esper_target_patch(romfile, patch_dst=0xF8700):
         # 6B            RTL        [Return to normal execution]
         0x6B
     ]
-    romfile = romfile[:patch_dst] + bytes(patch_data) + romfile[patch_dst + len(patch_data):]
+    romfile.write(patch_dst, patch_data, descr="esper target patch")
 
     return romfile
 
@@ -2,14 +2,24 @@ import logging
 log = logging.getLogger("ai_scribe")
 log.setLevel(logging.INFO)
 
+from collections import defaultdict, namedtuple
+
+import numpy
+
+from . import syntax
 from .syntax import SYNTAX
 
 from . import _NAME_ALIASES
+from . import cache
 from . import scripting
+from .rom import RomImage
 from .scripting import translate, _CHARS
 
 # Allow no more than this number of 0xFF bytes in a potential script
 _MAX_FF_TOLERANCE = 16
+# Bump this whenever a change here alters what is extracted from a ROM,
+# cached extraction results from other versions are then discarded
+PARSER_VERSION = 1
 
 # FIXME: Helper class while we transition indexing schemes
 class ScriptSet:
@@ -72,22 +82,36 @@ class ScriptSet:
         # case 4 string, not aliased, must be canonical name
         return self.canonical_names.index(name)
 
-    def __init__(self, romfile):
+    def __init__(self, romfile, use_cache=True):
         self.scripts = None
         self.script_ptrs = None
         self.canonical_names = None
         self.is_bc = False
-        self.init_from_rom(romfile)
-
-    def init_from_rom(self, romfile):
-        self.scripts, self.canonical_names, self.script_blocks = extract(romfile, return_names=True)
-        self.script_ptrs = extract_script_ptrs(romfile)
-        self.is_bc = detect_bc(self.script_ptrs)
-        self.aliased_names = extract_names(romfile, alias_duplicates=True)
+        self.init_from_rom(romfile, use_cache=use_cache)
+
+    def init_from_rom(self, romfile, use_cache=True):
+        record = load_rom(romfile, use_cache=use_cache)
+        self.table = record["table"]
+        self.scripts = record["scripts"]
+        self.canonical_names = record["canonical_names"]
+        self.script_blocks = record["script_blocks"]
+        self.script_ptrs = record["script_ptrs"]
+        self.is_bc = record["is_bc"]
+        self.aliased_names = record["aliased_names"]
+        self._opcode_index = None
 
     def __getitem__(self, name):
         return self.scripts[self._get_index(name)]
 
+    @property
+    def opcode_index(self):
+        """
+        `OpcodeIndex` over the extracted scripts, built on first use.
+        """
+        if self._opcode_index is None:
+            self._opcode_index = OpcodeIndex(self.scripts)
+        return self._opcode_index
+
     def get_ordered_script_array(self):
         return [self.scripts[n] for n in range(len(self.scripts))]
 
@@ -97,8 +121,8 @@ def get_subgraph(g, nodes=None):
     return g.subgraph(nodes)
 
 def non_vanilla_ptrs(script_ptrs):
-    return [ptr for ptr in script_ptrs
-                    if ptr not in range(0xF8700, 0xFC050)]
+    script_ptrs = numpy.asarray(script_ptrs)
+    return script_ptrs[(script_ptrs < 0xF8700) | (script_ptrs >= 0xFC050)]
 
 def detect_bc(script_ptrs):
     """
@@ -147,139 +171,160 @@ EVENT_TO_CANONICAL_NAME_MAP = {
     0x1F: "Wrexsoul",
     0x20: "Kefka2",
 }
+OpcodeOccurrence = namedtuple("OpcodeOccurrence", ["script", "offset", "args"])
+
+class OpcodeIndex:
+    """
+    Inverted index from opcodes to where they are used in a set of scripts.
+
+    Every command (0xF0 -- 0xFF) and skill byte (anything lower) maps to all of its occurrences
+    as a token, so arguments are never mistaken for opcodes. Occurrences are
+    (script, offset, args) tuples, in script order and then by offset within the script.
+
+    >>> index = OpcodeIndex({"Guard": bytes([0xF7, 0x05, 0xFF, 0xFF]),
+    ...                      "Leafer": bytes([0x01, 0xF7, 0x06, 0xFF, 0xFF])})
+    >>> index[syntax.SpecialEvent]
+    [OpcodeOccurrence(script='Guard', offset=0, args=(5,)), OpcodeOccurrence(script='Leafer', offset=1, args=(6,))]
+    """
+    def __init__(self, scripts):
+        self._index = defaultdict(list)
+        for name, script in scripts.items():
+            for offset, opcode, args in scripting.iter_tokens(script):
+                self._index[opcode].append(OpcodeOccurrence(name, offset, tuple(args)))
+
+    @classmethod
+    def load(cls, scripts):
+        """
+        Return `scripts` if it is already an `OpcodeIndex`, otherwise index it.
+        """
+        if isinstance(scripts, cls):
+            return scripts
+        return cls(scripts)
+
+    @staticmethod
+    def _key(opcode):
+        return opcode._BYTEVAL if isinstance(opcode, type) else opcode
+
+    def __getitem__(self, opcode):
+        """
+        All occurrences of `opcode` (byte value or `syntax.Cmd` subclass), empty if it is never used.
+        """
+        return self._index.get(self._key(opcode), [])
+
+    def __contains__(self, opcode):
+        return self._key(opcode) in self._index
+
+    def scripts_with(self, opcode):
+        """
+        `list` of the scripts using `opcode`, in script order.
+        """
+        return [*dict.fromkeys(occ.script for occ in self[opcode])]
+
+    def by_script(self, opcode):
+        """
+        `dict` of script -> `list` of the arguments of each use of `opcode` in that script.
+        """
+        args = defaultdict(list)
+        for occ in self[opcode]:
+            args[occ.script].append(occ.args)
+        return dict(args)
+
 def identify_special_event_scripts(scripts):
-    events = {}
-    for name, script in scripts.items():
-        # In vanilla (and probably BC) 0xF7 can't appear in an
-        # enemy script unless it refers to an argument or variable of
-        # some kind (e.g. *not* the desperation attack byte)
-        # FIXME: make has_xxx_byte and has_special_event, etc...
-        if 0xF7 in script._bytes:
-            idx = script._bytes.index(0xF7)
-            events[script._bytes[idx + 1]] = name
-
-    return events
+    """
+    Map each special event to the script triggering it.
+
+    :param scripts: `dict` of scripts, or an `OpcodeIndex` over them
+    """
+    index = OpcodeIndex.load(scripts)
+    # Truncated commands have no event to report
+    return {occ.args[0]: occ.script for occ in index[syntax.SpecialEvent] if occ.args}
 
 def identify_formation_alterations(scripts):
-    alts = {}
-    for name, script in scripts.items():
-        # In vanilla (and probably BC) 0xF5 can't appear in an
-        # enemy script unless it refers to an argument or variable of
-        # some kind (e.g. *not* the desperation attack byte)
-        # FIXME: make has_xxx_byte and has_special_event, etc...
-        if 0xF5 in script._bytes:
-            idx = script._bytes.index(0xF5)
-            alts[name] = tuple(script._bytes[idx + 1:idx + 4])
-
-    return alts
+    return OpcodeIndex.load(scripts).by_script(syntax.AlterFormation)
 
 def identify_formation_swaps(scripts):
-    swaps = {}
-    for name, script in scripts.items():
-        # In vanilla (and probably BC) 0xF2 can't appear in an
-        # enemy script unless it refers to an argument or variable of
-        # some kind (e.g. *not* the desperation attack byte)
-        # FIXME: make has_xxx_byte and has_special_event, etc...
-        if 0xF2 in script._bytes:
-            idx = script._bytes.index(0xF2)
-            swaps[name] = tuple(script._bytes[idx + 1:idx + 4])
-
-    return swaps
+    return OpcodeIndex.load(scripts).by_script(syntax.ChangeFormation)
 
 def identify_special_animations(scripts):
-    anim = {}
-    for name, script in scripts.items():
-        # In vanilla (and probably BC) 0xFA can't appear in an
-        # enemy script unless it refers to an argument or variable of
-        # some kind (e.g. *not* the desperation attack byte)
-        # FIXME: make has_xxx_byte and has_special_event, etc...
-        if 0xFA in script._bytes:
-            idx = script._bytes.index(0xFA)
-            anim[name] = tuple(script._bytes[idx + 1:idx + 4])
-
-    return anim
+    return OpcodeIndex.load(scripts).by_script(syntax.SpecAct)
+
+def scan_script_end(romfile, ptr, nblocks=2, max_ff=_MAX_FF_TOLERANCE):
+    """
+    Find the end of the script beginning at `ptr` with a single forward pass over its commands.
+
+    :param romfile: ROM data to scan
+    :param ptr: `int` absolute address of the start of the script
+    :param nblocks: `int` number of (top level) END BLOCK commands which terminate the script
+    :param max_ff: `int` maximum number of 0xFF bytes (including arguments) allowed before giving up
+    :return: `int` absolute address one past the final END BLOCK
+    """
+    eptr, nff, nbytes_ff = ptr, 0, 0
+    while nff < nblocks:
+        if eptr >= len(romfile):
+            raise ValueError(f"Script at {hex(ptr)} runs past the end of the ROM.")
+
+        cmd = romfile[eptr]
+        width = syntax.TOKEN_WIDTH[cmd]
+        if cmd == syntax.EndBlock._BYTEVAL:
+            nff += 1
+        nbytes_ff += sum(b == 0xFF for b in romfile[eptr:eptr + width])
+        if nbytes_ff > max_ff:
+            raise ValueError(f"Script at {hex(ptr)} has more than {max_ff} 0xFF bytes "
+                             f"before its final END BLOCK.")
+        eptr += width
+
+    return eptr
 
 def extract_scripts(romfile, script_ptrs, names, return_blocks=False):
     # FIXME: script_ptrs should index like an array to avoid duplicate names
-    scripts = dict(zip(names, script_ptrs))
-    scripts = dict(sorted(scripts.items(), key=lambda t: t[1]))
-    _ptrs = scripts.copy()
-
-    non_std_ptrs = non_vanilla_ptrs(script_ptrs)
-    non_std_ptrs = {name: ptr for name, ptr in scripts.items()
-                                            if ptr in non_std_ptrs}
+    script_ptrs = numpy.asarray(script_ptrs)
+    # Scripts are processed in pointer order
+    order = numpy.argsort(script_ptrs, kind="stable")
 
     # We don't know if these bytes are used or not
     # FIXME: just clip the last script
-    if len(non_std_ptrs) > 0:
-        scripts = {name: ptr for name, ptr in scripts.items()
-                                           if name not in non_std_ptrs}
+    non_std = numpy.isin(script_ptrs, non_vanilla_ptrs(script_ptrs))
+    non_std_ptrs = {names[i]: int(script_ptrs[i]) for i in order[non_std[order]]}
 
     # TODO: make the final pointer None and scan the end of the block to truncate
-    # Define script boundaries
-    script_ptrs = sorted(set(scripts.values()) | {0xFC050})
-    script_ptrs = dict(zip(script_ptrs[:-1], script_ptrs[1:]))
+    # Define script boundaries --- each script runs up to the next distinct pointer
+    bounds = numpy.unique(numpy.append(script_ptrs[~non_std], 0xFC050))
+    std_idx = order[~non_std[order]]
+    std_lens = numpy.diff(bounds)[numpy.searchsorted(bounds, script_ptrs[std_idx])]
 
     # Determine script blocks --- vanilla has one, but other modifications may introduce others
-    script_blocks = [(min(script_ptrs.keys()), max(script_ptrs.values()))]
+    script_blocks = [(int(bounds[0]), int(bounds[-1]))]
 
-    invalid = {}
-    #scripts = {v: k for k, v in scripts.items()}
-    for i, name in enumerate(names):
-        if name in non_std_ptrs:
-            continue
-        sptr, eptr = scripts[i], script_ptrs[scripts[i]]
-        bin_script = romfile[sptr:eptr]
+    scripts, invalid = {}, {}
+    for i, sptr, slen in zip(std_idx.tolist(), script_ptrs[std_idx].tolist(), std_lens.tolist()):
+        name = names[i]
+        s = scripting.Script.from_rom(sptr, slen, name, romfile)
         try:
-            scripting.Script.validate(bin_script, allow_empty_fc=True)
+            scripting.Script.validate(s, allow_empty_fc=True)
         except Exception as e:
             #raise ValueError(f"Script for {name} is invalid.")
-            invalid[name] = scripting.Script.from_rom(sptr, eptr - sptr, name, romfile)
-        s = scripting.Script.from_rom(sptr, eptr - sptr, name, romfile)
+            invalid[name] = scripting.Script.from_rom(sptr, slen, name, romfile)
         #log.debug(f"{name} {s.name}\n{s.translate()}")
         # FIXME: obviated
         assert s.name == name, (s.name, name)
-        assert s._bytes == bin_script
 
         scripts[name] = s
 
     # Handle scripts in nonstandard locations
     for name, ptr in non_std_ptrs.items():
         log.info(f"Non standard pointer location {hex(ptr)} -> {name}")
-        # heuristic: count number of end blocks
-        # This will be confused by the appearance of "Nothing" in skill selection lists
-        # So, we try to acquire blocks until it "makes sense"...
-        eptr, _script = ptr, b''
-        while _script.count(b'\xFF') <= _MAX_FF_TOLERANCE:
-            eptr = romfile.index(b'\xFF', eptr) + 1
-            _script = romfile[ptr:eptr]
-
-            # Try to validate
-            try:
-                scripting.Script.validate(_script, allow_empty_fc=True)
-            except Exception as e:
-                log.debug(e)
-                continue
-
-            # If validation succeeds, and we have two valid blocks
-            # we have a valid script
-            script = scripting.Script(_script, name, ptr)
-            try:
-                # FIXME: can't check for nff >= 2, condition can be triggered
-                # by incomplete scripts
-                if script.translate().count("END BLOCK") == 2:
-                    break
-            except Exception as e:
-                log.debug(e)
-                continue
-
-        # This is only executed if we hit the maximum tolerance,
-        # which is a failure condition
-        else:
+        # Walk the commands (skipping over their arguments, so that e.g. "Nothing" in skill
+        # selection lists is not confused for a block ender) until we find two END BLOCKs
+        try:
+            eptr = scan_script_end(romfile, ptr)
+            script = scripting.Script.from_rom(ptr, eptr - ptr, name, romfile)
+            scripting.Script.validate(script, allow_empty_fc=True)
+        except ValueError as e:
+            log.debug(e)
             log.error(f"Script for {name} cannot be properly parsed; "
                       "it is likely that this is an invalid script. "
                       "If possible, script follows:")
-            log.error(script.translate(allow_partial=True, memblk=True))
+            log.error(translate(bytes(romfile[ptr:ptr + 0x100]), allow_partial=True, memblk=True))
             exit()
 
         if eptr - ptr >= 1000:
@@ -315,28 +360,31 @@ def extract_scripts(romfile, script_ptrs, names, return_blocks=False):
         return scripts, script_blocks
     return scripts
 
+def extract_battle_msg_ptrs(romfile, offset=0xFDFE0, total_ptrs=0x100, block_offset=0xF0000):
+    romfile = RomImage.load(romfile)
+
+    chunk = romfile[offset:offset + total_ptrs * 2]
+    # astype copies, so we don't hold onto the ROM
+    return numpy.frombuffer(chunk, dtype="<u2").astype(numpy.int64) + block_offset
+
 def extract_battle_msgs(romfile):
-    battle_msg_ptrs  = romfile[0xFDFE0:0xFE1E0]
-    battle_msg_ptrs = [int.from_bytes(bytes([low, high]), "little") + 0xF0000
-                        for low, high in zip(battle_msg_ptrs[::2], battle_msg_ptrs[1::2])]
+    romfile = RomImage.load(romfile)
 
     # bookend the ptrs on the end
-    battle_msg_ptrs.append(0xFF44F)
-    battle_msg_ptrs = sorted([t[::-1] for t in enumerate(battle_msg_ptrs)], key=lambda t: t[0])
+    battle_msg_ptrs = numpy.append(extract_battle_msg_ptrs(romfile), 0xFF44F)
+    order = numpy.argsort(battle_msg_ptrs, kind="stable")
+    sorted_ptrs = battle_msg_ptrs[order].tolist()
+
     battle_msgs = {}
-    for ptr1, ptr2 in zip(battle_msg_ptrs[:-1], battle_msg_ptrs[1:]):
-            ptr1, i = ptr1
-            ptr2 = ptr2[0]
-            battle_msgs[i] = romfile[ptr1:ptr2]
+    for i, ptr1, ptr2 in zip(order[:-1].tolist(), sorted_ptrs[:-1], sorted_ptrs[1:]):
+            battle_msgs[i] = bytes(romfile[ptr1:ptr2])
 
             # TODO: translate
 
     return battle_msgs
 
 def extract_names(romfile, alias_duplicates=True, offset=0xFC050, name_len=10, total_names=384):
-    if isinstance(romfile, str):
-        with open(romfile, "rb") as fin:
-            romfile = fin.read()
+    romfile = RomImage.load(romfile)
 
     names = []
     ptrs = [offset + name_len * idx for idx in range(total_names + 1)]
@@ -356,37 +404,70 @@ def extract_names(romfile, alias_duplicates=True, offset=0xFC050, name_len=10, t
     return names
 
 def extract_script_ptrs(romfile, block_offset=0xF8700, offset=0xF8400, total_ptrs=384):
-    if isinstance(romfile, str):
-        with open(romfile, "rb") as fin:
-            romfile = fin.read()
+    romfile = RomImage.load(romfile)
 
     chunk = romfile[offset:offset + total_ptrs * 2]
-    script_ptrs = [int.from_bytes(bytes([low, high]), "little") + block_offset
-                   for low, high in zip(chunk[::2], chunk[1::2])]
+    # astype copies, so we don't hold onto the ROM
+    return numpy.frombuffer(chunk, dtype="<u2").astype(numpy.int64) + block_offset
 
-    return script_ptrs
-
-def extract(romfile=None, return_names=False):
-    with open(romfile, "rb") as fin:
-        romfile = fin.read()
-
-    script_ptrs = extract_script_ptrs(romfile)
+def _extract_record(rom):
+    script_ptrs = extract_script_ptrs(rom)
     # Canonical names
-    names = extract_names(romfile, alias_duplicates=False)
+    names = extract_names(rom, alias_duplicates=False)
     _names = [*range(len(names))]
 
-    # Detect if BC has changed the scripts or their structure in some way
-    is_bc = detect_bc(script_ptrs)
-    log.info(f"ROM type: {'bc' if is_bc else 'vanilla'}")
-
-    scripts, script_blocks = extract_scripts(romfile, script_ptrs, _names, return_blocks=True)
+    scripts, script_blocks = extract_scripts(rom, script_ptrs, _names, return_blocks=True)
 
     # map script to canonical name
     #scripts = {n: scripts[idx] for idx, n in enumerate(_names)}
 
+    return {
+        # Keep all of the scripts in one buffer, in extraction order
+        "table": scripting.ScriptTable.from_scripts(scripts),
+        "script_ptrs": script_ptrs,
+        "script_blocks": script_blocks,
+        "canonical_names": names,
+        "aliased_names": extract_names(rom, alias_duplicates=True),
+        # Detect if BC has changed the scripts or their structure in some way
+        "is_bc": detect_bc(script_ptrs),
+    }
+
+def load_rom(romfile, use_cache=True):
+    """
+    Extract the scripts, pointers, blocks and names from `romfile`.
+
+    Results are cached on disk keyed by the SHA-256 of the ROM contents, so that subsequent
+    loads of the same ROM do not need to reparse it. See `cache.cache_dir` for the location.
+
+    :param romfile: path to the ROM or ROM data (e.g. a `RomImage`)
+    :param use_cache: `bool` whether to check and populate the extraction cache
+    :return: `dict` of extraction results
+    """
+    rom = RomImage.load(romfile)
+    try:
+        digest = cache.rom_digest(rom) if use_cache else None
+        record = cache.load(digest, PARSER_VERSION) if use_cache else None
+        if record is not None:
+            log.debug(f"Loaded extraction results for {digest} from cache")
+        else:
+            record = _extract_record(rom)
+            if use_cache:
+                cache.save(digest, PARSER_VERSION, record)
+    finally:
+        if rom is not romfile:
+            rom.close()
+
+    record["scripts"] = record["table"].to_dict()
+
+    log.info(f"ROM type: {'bc' if record['is_bc'] else 'vanilla'}")
+    return record
+
+def extract(romfile=None, return_names=False, use_cache=True):
+    record = load_rom(romfile, use_cache=use_cache)
+
     if return_names:
-        return scripts, names, script_blocks
-    return scripts
+        return record["scripts"], record["canonical_names"], record["script_blocks"]
+    return record["scripts"]
 
 # Unused, could be in the future if fully integrated with BC
 def extract_scripts_bc():
@@ -1,6 +1,9 @@
 import logging
 log = logging.getLogger("ai_scribe")
 
+import numpy
+
+from .rom import RomBuffer
 from .scripting import Script
 def package_rom(romfile, outf="test.smc"):
     pass
@@ -46,7 +49,7 @@ def pack_scripts(export, orig_ptrs, script_blocks=DEFAULT_BLOCK,
         slen = len(export[n])
         # FIXME: restore pointer rewriting
         #log.debug(f">{n}: {hex(names[n])} -> {hex(0xF8700 + last)} +{hex(slen)}")
-        log.debug(f">{n}: -> {hex(0xF8700 + last)} +{hex(slen)}")
+        log.debug(">%s: -> %#x +%#x", n, 0xF8700 + last, slen)
         last += slen
         block_offsets[block] = last
 
@@ -66,7 +69,7 @@ def pack_scripts(export, orig_ptrs, script_blocks=DEFAULT_BLOCK,
             block_scrs[block].append(export[n]._bytes)
 
             slen = len(export[n])
-            log.debug(f"{n}: -> [{hex(block[0])} {hex(block[1])}] | {hex(0xF8700 + last)} +{hex(slen)}")
+            log.debug("%s: -> [%#x %#x] | %#x +%#x", n, block[0], block[1], 0xF8700 + last, slen)
             last += slen
 
             block_offsets[block] = last
@@ -88,18 +91,19 @@ def pack_scripts(export, orig_ptrs, script_blocks=DEFAULT_BLOCK,
     return block_scrs, ptrs
 
 def construct_ptr_block(ptrs):
-    low = b""
-    for ptr in ptrs:
-        low += int.to_bytes(ptr, 2, byteorder="little")
-    return low
+    ptrs = numpy.asarray(ptrs, dtype=numpy.int64)
+    # Older versions of numpy would silently wrap these
+    if len(ptrs) > 0 and (ptrs.min() < 0 or ptrs.max() > 0xFFFF):
+        raise OverflowError("Script pointers must fit in two bytes")
+    return ptrs.astype("<u2").tobytes()
 
 def construct_scr_block(scr):
-    low = b""
-    for s in scr:
-        low += bytes(s)
-    return low
+    # The scripts are usually views into a ScriptTable, so this is the only copy
+    return b"".join(scr)
 
 def write_script_blocks(romfile, blocks):
+    romfile = RomBuffer.load(romfile)
+
     for (low, hi), data in blocks.items():
         block_diff = (hi - low) - len(data)
 
@@ -111,7 +115,7 @@ def write_script_blocks(romfile, blocks):
             raise ValueError(f"Script block overruns block bounds: {hex(low)} + {hex(len(data))} > {hex(hi)}")
 
         log.debug(f"Writing data block length {hex(len(data))} to ({hex(low)}, {hex(hi)})")
-        romfile = romfile[:low] + data + romfile[hi:]
+        romfile.write(low, data, descr=f"script block ({hex(low)}, {hex(hi)})")
 
     return romfile
 
@@ -120,9 +124,16 @@ SCRIPT_BLOCK_LEN = 0xFC050 - 0xF8700
 def randomize_scripts(g, n=384, ptr_off=0, total_len=SCRIPT_BLOCK_LEN, **kwargs):
     scripts = []
     _n = n
+    # Generate the whole area at once if the graph supports it
+    batch = getattr(g, "generate_batch", None)
     while len(scripts) < _n:
-        scripts += [g.generate_from_graph(**kwargs) for _ in range(_n - len(scripts))]
-        scripts = [script for script in scripts if Script.validate(bytes(script))][:n]
+        if batch is not None:
+            scripts += batch(_n - len(scripts), **kwargs)
+        else:
+            scripts += [g.generate_from_graph(**kwargs) for _ in range(_n - len(scripts))]
+        if not g.VALIDATES_OUTPUT:
+            scripts = [script for script in scripts if Script.validate(bytes(script))]
+        scripts = scripts[:n]
 
     # Pair down longest scripts until we arrive at something we can fit in the ROM space
     while sum(map(len, scripts)) > total_len:
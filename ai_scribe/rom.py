@@ -0,0 +1,133 @@
+import mmap
+import logging
+log = logging.getLogger("ai_scribe")
+
+class RomImage:
+    """
+    Read-only view of a ROM file on disk.
+
+    The file is opened once and memory mapped, slicing returns zero-copy `memoryview` objects
+    so that the various extraction routines can share the same underlying data without
+    each having to read the whole file. Consumers which need to hold onto data after the image
+    is closed should copy it out (e.g. with `bytes`).
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        log.debug(f"Mapped {fname}: {len(self._mmap)} bytes")
+
+    @classmethod
+    def load(cls, romfile):
+        """
+        Return `romfile` as something which can be sliced like a ROM: paths are mapped into a new `RomImage`,
+        anything else (`RomImage`, `bytes`, `bytearray`, ...) is passed through untouched.
+        """
+        if isinstance(romfile, str):
+            return cls(romfile)
+        return romfile
+
+    def __len__(self):
+        return len(self._view)
+
+    def __getitem__(self, key):
+        return self._view[key]
+
+    def __bytes__(self):
+        return bytes(self._view)
+
+    def find(self, sub, start=0, end=None):
+        return self._mmap.find(sub, start, len(self) if end is None else end)
+
+    def index(self, sub, start=0, end=None):
+        idx = self.find(sub, start, end)
+        if idx == -1:
+            raise ValueError("subsection not found")
+        return idx
+
+    def close(self):
+        if self._mmap.closed:
+            return
+        # This will raise if there are still slices referring to the map
+        self._view.release()
+        self._mmap.close()
+
+    @property
+    def closed(self):
+        return self._mmap.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"<RomImage: {self.fname}, {len(self._mmap) if not self.closed else 'closed'}>"
+
+class RomBuffer:
+    """
+    Mutable in-memory copy of a ROM.
+
+    Writes happen in place on a `bytearray`, so the cost of a modification is proportional to
+    the number of bytes written rather than the size of the ROM. Every write is also recorded
+    (see `patches` and `changed_ranges`) so that callers can inspect exactly what was changed.
+    """
+    def __init__(self, romfile):
+        self._data = bytearray(romfile[:])
+        # (start, end, description) for every write, in order
+        self.patches = []
+
+    @classmethod
+    def load(cls, romfile):
+        """
+        Return `romfile` if it is already a `RomBuffer`, otherwise copy it into a new one. Paths are
+        mapped only for as long as it takes to copy them.
+        """
+        if isinstance(romfile, cls):
+            return romfile
+        if isinstance(romfile, str):
+            with RomImage(romfile) as rom:
+                return cls(rom)
+        return cls(romfile)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __bytes__(self):
+        return bytes(self._data)
+
+    def write(self, ptr, data, descr=None):
+        """
+        Overwrite the bytes starting at `ptr` with `data`. Writes may not change the length of the ROM.
+
+        :param ptr: `int` absolute address to start writing at
+        :param data: bytes-like or `list` of `int` data to write
+        :param descr: `str` optional description of the write, kept in the patch log
+        """
+        end = ptr + len(data)
+        if ptr < 0 or end > len(self._data):
+            raise ValueError(f"Write of {hex(len(data))} bytes to {hex(ptr)} is out of bounds of the ROM "
+                             f"({hex(len(self._data))} bytes)")
+        self._data[ptr:end] = data
+        self.patches.append((ptr, end, descr))
+
+    def changed_ranges(self):
+        """
+        Return the sorted `list` of (start, end) ranges which have been written to, with overlapping
+        and adjacent ranges merged.
+        """
+        ranges = []
+        for low, hi, _ in sorted(self.patches, key=lambda t: t[:2]):
+            if ranges and low <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(hi, ranges[-1][1]))
+                continue
+            ranges.append((low, hi))
+        return ranges
+
+    def __repr__(self):
+        return f"<RomBuffer: {hex(len(self._data))} bytes, {len(self.patches)} writes>"
@@ -1,3 +1,7 @@
+import collections
+
+import numpy
+
 from . import flags
 from . import syntax
 from .syntax import SYNTAX
@@ -15,33 +19,60 @@ _CHARS[255] = ""
 _CHARS[254] = " "
 _CHARS[196] = "-"
 
+TOKEN_DTYPE = numpy.dtype([("offset", "<u2"), ("opcode", "u1"), ("nargs", "u1")])
+_TOKEN_WIDTH = numpy.array(syntax.TOKEN_WIDTH)
+
+def tokenize(script):
+    """
+    Split a script into its tokens: a command byte and its arguments, or a single skill byte.
+
+    :param script: a `Script` (whose tokens are cached) or bytes-like / `list` of byte values
+    :return: `numpy` structured array with fields `offset` (position of the token in the script),
+        `opcode` (the command or skill byte, values below 0xF0 are skills) and `nargs` (the number
+        of argument bytes following the opcode, this is less than expected for a truncated script)
+    """
+    if isinstance(script, Script):
+        return script.tokens
+
+    width = syntax.TOKEN_WIDTH
+    offsets, i, n = [], 0, len(script)
+    while i < n:
+        offsets.append(i)
+        i += width[script[i]]
+
+    tokens = numpy.empty(len(offsets), dtype=TOKEN_DTYPE)
+    tokens["offset"] = offsets
+    tokens["opcode"] = numpy.frombuffer(bytes(script), dtype=numpy.uint8)[tokens["offset"]]
+    tokens["nargs"] = numpy.minimum(_TOKEN_WIDTH[tokens["opcode"]] - 1, n - tokens["offset"] - 1)
+    return tokens
+
+def iter_tokens(script):
+    """
+    Iterate over (offset, opcode, args) for every token in the script, `args` is a `bytes` slice.
+    """
+    tokens = tokenize(script)
+    script = bytes(script)
+    for offset, opcode, nargs in zip(*[tokens[f].tolist() for f in TOKEN_DTYPE.names]):
+        yield offset, opcode, script[offset + 1:offset + 1 + nargs]
+
+def is_truncated(tokens):
+    """
+    Whether the final token of a tokenized script is missing arguments.
+    """
+    return len(tokens) > 0 \
+            and tokens["nargs"][-1] < syntax.TOKEN_WIDTH[tokens["opcode"][-1]] - 1
+
 def translate(script, memblk=False, allow_partial=False):
-    script = [*script].copy()
-    script.append(-0x1)
     s = ""
 
     if memblk:
-        for i, b in enumerate(script):
+        for i, b in enumerate([*script, -0x1]):
             if i % 16 == 0:
                 s += "\n" + hex(i).rjust(6) + " "
             s += hex(b).rjust(4) + " "
         s += "\n"
 
-    while True:
-        try:
-            v = script.pop(0)
-        except Exception as e:
-            if allow_partial:
-                print(e)
-                return s
-            raise e
-        if v == -0x1:
-            break
-        try:
-            v = int(v)
-        except ValueError:
-            pass
-
+    for offset, v, script in iter_tokens(script):
         if v not in SYNTAX:
             #print(f"[] {flags.SPELL_LIST[v]}")
             s += f"[] {flags.SPELL_LIST[v]}\n"
@@ -51,9 +82,15 @@ def translate(script, memblk=False, allow_partial=False):
         ext = f"+{nbytes}" if nbytes is not None else ""
         s += f"[{hex(v)}{ext}] {descr}\n"
 
+        if len(script) < (nbytes or 0):
+            e = IndexError(f"Script ends before the arguments to {hex(v)} at offset {offset}")
+            if allow_partial:
+                print(e)
+                return s
+            raise e
+
         if v == 0xFC:
             mod1, mod2, mod3 = script[:3]
-            script = script[3:]
 
             mod1 = flags.FC_MODIFIERS.get(mod1, hex(mod1))
             #print(f"\t{mod1} {hex(mod2)} {hex(mod3)}")
@@ -83,7 +120,6 @@ def translate(script, memblk=False, allow_partial=False):
             else:
                 v = " ".join(map(hex, script[:nbytes]))
             s += f"\t{v}\n"
-            script = script[nbytes:]
 
     return s
 
@@ -92,22 +128,50 @@ def add_one_time_trigger(script, trigger):
     return fire_once + trigger + script
 
 class Script:
+    # Scripts are numerous and often just views into a ScriptTable, so keep them light
+    __slots__ = ("ptr", "name", "_content", "_table", "_idx", "_tokens")
+
     def __init__(self, content=b"", name=None, ptr=None):
         self.ptr = ptr
-        self._bytes = content
         self.name = name
+        self._table = self._idx = None
+        self._bytes = content
+
+    @classmethod
+    def _from_table(cls, table, idx):
+        script = cls.__new__(cls)
+        script.ptr = table.ptrs[idx]
+        script.name = table.names[idx]
+        script._content = None
+        script._table, script._idx = table, idx
+        script._tokens = None
+        return script
+
+    @property
+    def _bytes(self):
+        if self._table is not None:
+            return self._table.script_bytes(self._idx)
+        return self._content
+
+    @_bytes.setter
+    def _bytes(self, content):
+        # Assigning new content detaches the script from its table
+        self._content = content
+        self._table = self._idx = None
+        self._tokens = None
 
     @classmethod
     def from_rom(cls, ptr, plen, name, romfile):
         s = e = ptr
         e += plen
-        return Script(romfile[s:e], name, ptr)
+        # Copy out, the ROM may be a view onto a file which will be closed
+        return Script(bytes(romfile[s:e]), name, ptr)
 
     def __len__(self):
         return len(self._bytes)
 
     def __bytes__(self):
-        return self._bytes
+        return bytes(self._bytes)
 
     def __repr__(self):
         if self._bytes is None:
@@ -123,8 +187,21 @@ class Script:
     def to_script_objs(self):
         pass
 
+    @property
+    def tokens(self):
+        """
+        Tokenized form of the script (see `tokenize`), computed once and cached.
+        """
+        # Replacing the bytes (e.g. by fixes applied after extraction) resets this
+        if self._tokens is None:
+            self._tokens = tokenize(self._bytes)
+        return self._tokens
+
     @classmethod
     def validate(cls, script, allow_empty_fc=False):
+        tokens = tokenize(script)
+        script = bytes(script)
+
         if not script[-1] == 0xFF:
             assert script.endswith(b'\xFF'), translate(script, memblk=True, allow_partial=True)
             return False
@@ -143,34 +220,28 @@ class Script:
             #return False
 
         # Check for empty FC blocks
-        for i in range(len(script) - 5):
-            if not allow_empty_fc and script[i] == 0xFC and script[i + 4] in {0xFE, 0XFF}:
-                raise ValueError(f"Script hase empty FC block\n" +
-                                 translate(script, memblk=True, allow_partial=True))
-                return False
+        opcodes = tokens["opcode"]
+        if not allow_empty_fc and numpy.any((opcodes[:-1] == syntax.CmdPred._BYTEVAL)
+                                            & (opcodes[1:] >= syntax.EndPredBlock._BYTEVAL)):
+            raise ValueError(f"Script hase empty FC block\n" +
+                             translate(script, memblk=True, allow_partial=True))
 
-        # Translating can reveal parsing errors
-        try:
-            translate(script)
-        except:
-            #print(translate(script, memblk=True, allow_partial=True))
+        # A command missing its arguments is a parsing error
+        if is_truncated(tokens):
             raise ValueError("Couldn't translate script.")
         return True
 
     #def __repr__(self):
     def translate(self, **kwargs):
-        cpy = [*self._bytes]
-
         trans = ""
-        while len(cpy) > 0:
-            if syntax.Cmd._CMD_REG.get(cpy[0], None) is None:
-                trans += "[] " + syntax.DoSkill.format_args(cpy.pop(0)) + "\n"
+        for _, v, args in iter_tokens(self):
+            if v not in syntax.Cmd._CMD_REG:
+                trans += "[] " + syntax.DoSkill.format_args(v) + "\n"
                 continue
 
-            cmd = syntax.Cmd._CMD_REG.get(cpy.pop(0), None) or cmd
+            cmd = syntax.Cmd._CMD_REG[v]
             nbytes, descr = cmd._NARGS, cmd._DESCR
 
-            args, cpy = cpy[:nbytes], cpy[nbytes:]
             fmtargs = cmd.format_args(*args)
 
             bval = cmd._BYTEVAL if cmd._BYTEVAL == "_" else hex(cmd._BYTEVAL)
@@ -201,9 +272,250 @@ class Script:
 
         return sum([math.log2(n) for n in p1])
 
+class ScriptTable:
+    """
+    A set of scripts stored in a single buffer, rather than one `bytes` object per script.
+
+    Script `i` is `data[starts[i]:ends[i]]`. Tables built with `from_scripts` are packed back to
+    back (so `ends[i] == starts[i + 1]`), while `from_rom` can also index directly into the ROM
+    without copying. Indexing the table gives `Script` objects which are views into it.
+    """
+    def __init__(self, data, starts, ends, names=None, ptrs=None):
+        self.data = data
+        self._view = memoryview(data)
+        self.starts = numpy.asarray(starts, dtype=numpy.int64)
+        self.ends = numpy.asarray(ends, dtype=numpy.int64)
+        if len(self.starts) != len(self.ends):
+            raise ValueError(f"Mismatched script bounds: {len(self.starts)} starts, {len(self.ends)} ends")
+
+        # Plain ints are much faster to slice with than numpy scalars
+        self._bounds = [*zip(self.starts.tolist(), self.ends.tolist())]
+
+        self.names = [*range(len(self.starts))] if names is None else list(names)
+        self.ptrs = [None] * len(self.starts) if ptrs is None else list(ptrs)
+        self._scripts = [Script._from_table(self, i) for i in range(len(self.starts))]
+
+    @classmethod
+    def from_scripts(cls, scripts):
+        """
+        Pack scripts into a new table.
+
+        :param scripts: `dict` of name -> `Script` (or bytes-like), or a `list` of them
+            in which case scripts keep their own names, or are named by their position
+        """
+        if isinstance(scripts, dict):
+            names, scripts = [*scripts], [*scripts.values()]
+        else:
+            names = [s.name if getattr(s, "name", None) is not None else i
+                     for i, s in enumerate(scripts)]
+
+        content = [bytes(s) for s in scripts]
+        offsets = numpy.zeros(len(content) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(s) for s in content], out=offsets[1:])
+        ptrs = [getattr(s, "ptr", None) for s in scripts]
+        return cls(b"".join(content), offsets[:-1], offsets[1:], names=names, ptrs=ptrs)
+
+    @classmethod
+    def from_rom(cls, romfile, ptrs, lengths, names=None, copy=True):
+        """
+        Table of the scripts at `ptrs` in the ROM.
+
+        :param copy: `bool` if `False` the table is a view onto `romfile`, which then has to outlive it
+        """
+        ptrs = numpy.asarray(ptrs, dtype=numpy.int64)
+        ends = ptrs + numpy.asarray(lengths, dtype=numpy.int64)
+        if copy:
+            view = memoryview(romfile[:])
+            return cls.from_scripts({name: Script(view[s:e], name, p) for name, s, e, p in
+                                     zip(names or range(len(ptrs)), ptrs.tolist(), ends.tolist(), ptrs.tolist())})
+        return cls(romfile[:], ptrs, ends, names=names, ptrs=ptrs.tolist())
+
+    def __len__(self):
+        return len(self._scripts)
+
+    def __getitem__(self, idx):
+        return self._scripts[idx]
+
+    def __iter__(self):
+        return iter(self._scripts)
+
+    def script_bytes(self, idx):
+        """
+        Zero-copy `memoryview` of the bytes of script `idx`.
+        """
+        start, end = self._bounds[idx]
+        return self._view[start:end]
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    @property
+    def nbytes(self):
+        return int(self.lengths().sum())
+
+    def to_dict(self):
+        """
+        `dict` of name -> `Script` view, in table order.
+        """
+        return dict(zip(self.names, self._scripts))
+
+    def __repr__(self):
+        return f"<ScriptTable: {len(self)} scripts, {self.nbytes} bytes>"
+
+class StreamingValidator:
+    """
+    Incremental counterpart to `Script.validate`, for use while a script is being built.
+
+    Tokens are fed in one at a time with `push`, which raises a `ValueError` as soon as the
+    script built so far can no longer become a valid script. The validator is only updated
+    if the token is accepted, so a rejected token can simply be replaced by another.
+
+    >>> v = StreamingValidator()
+    >>> v.push(syntax.DoSkill, [0x0])
+    >>> v.push(syntax.EndBlock)
+    >>> v.push(syntax.EndBlock)
+    >>> v.complete
+    True
+    """
+    def __init__(self, allow_empty_fc=False, nblocks=2):
+        self.allow_empty_fc = allow_empty_fc
+        self.nblocks = nblocks
+        # Number of END BLOCKs seen
+        self.nff = 0
+        # Number of CMD PREDs in the currently open conditional block
+        self.nfc = 0
+        self.last = None
+        self.ntokens = 0
+
+    @property
+    def complete(self):
+        return self.nff >= self.nblocks
+
+    def check(self, cmd, args=()):
+        """
+        Return the reason `cmd` (with `args`) cannot be appended to the script, or `None` if it can.
+
+        :param cmd: `syntax.Cmd` subclass or byte value of the command, values below 0xF0 are skills
+        :param args: `list` of argument byte values
+        """
+        if not isinstance(cmd, type):
+            if cmd in syntax.Cmd._CMD_REG:
+                cmd = syntax.Cmd._CMD_REG[cmd]
+            else:
+                cmd, args = syntax.DoSkill, [cmd]
+
+        if self.complete:
+            return "token after end of script"
+        if len(args) != (cmd._NARGS or 0):
+            return f"{cmd._DESCR} takes {cmd._NARGS or 0} arguments, got {len(args)}"
+        if cmd is syntax.DoSkill and args[0] >= 0xF0:
+            return f"skill {hex(args[0])} would be read as a command"
+
+        if self.last is syntax.Targeting and cmd not in syntax.Targeting.VALID_TARGETABLE:
+            return f"{cmd._DESCR} cannot be targeted"
+        if self.last is syntax.CmdPred and not self.allow_empty_fc \
+                and cmd in {syntax.EndPredBlock, syntax.EndBlock}:
+            return "empty FC block"
+        if cmd is syntax.EndPredBlock and self.nfc == 0:
+            return "END FC BLOCK without open conditional"
+        return None
+
+    def push(self, cmd, args=()):
+        """
+        Append a token to the script, see `check` for the arguments.
+
+        :raises ValueError: if the token would make the script invalid
+        """
+        reason = self.check(cmd, args)
+        if reason is not None:
+            raise ValueError(f"Invalid token at position {self.ntokens}: {reason}")
+
+        if not isinstance(cmd, type):
+            cmd = syntax.Cmd._CMD_REG.get(cmd, syntax.DoSkill)
+
+        if cmd is syntax.CmdPred:
+            self.nfc += 1
+        # END BLOCK also closes any open conditional
+        elif cmd in {syntax.EndPredBlock, syntax.EndBlock}:
+            self.nfc = 0
+        self.nff += cmd is syntax.EndBlock
+        self.last = cmd
+        self.ntokens += 1
+
+    def finish(self):
+        """
+        Check that the script is complete.
+
+        :raises ValueError: if fewer than the expected number of blocks have been ended
+        """
+        if not self.complete:
+            raise ValueError(f"Script has {self.nff} of {self.nblocks} blocks ended")
+        return True
+
 # rules
 _RULES = {}
 
+class RuleContext:
+    """
+    Running summary of a script being generated, for the rules to look at instead of the script itself:
+    the last few tokens with their arguments, the number of CMD PREDs in the open conditional and the
+    block phase. Looking back is then constant time, however long the script is.
+
+    >>> rc = RuleContext()
+    >>> rc.push(syntax.CmdPred, [0x1, 0x5, 0x0])
+    >>> rc.appended(syntax.DoSkill, [0x0]).token_from_end(n=2)
+    <class 'ai_scribe.syntax.CmdPred'>
+    >>> rc.nfc
+    1
+    """
+    def __init__(self, depth=2):
+        """
+        :param depth: number of tokens to keep, the furthest back the rules can look
+        """
+        self._last = collections.deque(maxlen=depth)
+        self.nfc = 0
+        self.phase = "main"
+
+    def __len__(self):
+        return len(self._last)
+
+    def push(self, cmd, args=()):
+        """
+        Append a token.
+
+        :param cmd: `syntax.Cmd` subclass
+        :param args: `list` of argument byte values
+        """
+        self._last.append((cmd, list(args)))
+        if cmd is syntax.CmdPred:
+            self.nfc += 1
+        elif cmd is syntax.EndPredBlock:
+            self.nfc = 0
+        elif cmd is syntax.EndBlock:
+            self.nfc = 0
+            self.phase = "counter"
+
+    def appended(self, cmd, args=()):
+        """
+        Copy of the context with a candidate token pushed, this one is left as is. Only `depth` tokens are
+        copied, so this is cheap.
+        """
+        ctx = RuleContext.__new__(RuleContext)
+        ctx._last, ctx.nfc, ctx.phase = self._last.copy(), self.nfc, self.phase
+        ctx.push(cmd, args)
+        return ctx
+
+    def token_from_end(self, n=1, with_args=False):
+        """
+        The `n`th last token, like `Rule.get_nth_token_from_end`.
+
+        :raises IndexError: if fewer than `n` tokens are kept
+        """
+        if n < 1:
+            raise IndexError(f"no token {n} from the end")
+        cmd, args = self._last[-n]
+        return (cmd, args) if with_args else cmd
+
 class Rule:
     # put in flags
     ALL_SKILLS = set(range(256))
@@ -247,6 +559,9 @@ class Rule:
 
     @classmethod
     def get_nth_token_from_end(cls, script, n=1, with_args=False):
+        if isinstance(script, RuleContext):
+            return script.token_from_end(n, with_args)
+
         tidx = len(script)
         while n > 0:
             tidx -= 1
@@ -259,9 +574,21 @@ class Rule:
         return script[tidx]
 
     # Does the rule apply and is triggered?
+    # script is either the script so far or a RuleContext, read it with get_nth_token_from_end
     def __call__(self, script, **ctx):
         pass
 
+    def constrain(self, last, last_args, **ctx):
+        """
+        Work out ahead of time what may follow the token `last` (a `syntax.Cmd` subclass, or None at the start)
+        with arguments `last_args`, so that generation only draws tokens which keep to the rule.
+
+        :return: `dict` of command byte value -> `set` of argument values it may use, or None if it may
+            not follow at all. Commands left out are not restricted. Anything that cannot be
+            expressed like this is left to `__call__`.
+        """
+        return {}
+
     def suggest(self, script, **ctx):
         pass
     
@@ -273,8 +600,12 @@ class NoEmptyCondBlock(Rule):
         except IndexError:
             return False
 
-        return isinstance(tok, syntax.EndPredBlock) \
+        return tok is syntax.EndPredBlock \
                 and ctx["nfc"] == 0
+
+    def constrain(self, last, last_args, **ctx):
+        # Nothing to end without an open conditional
+        return {syntax.EndPredBlock._BYTEVAL: None} if ctx["nfc"] == 0 else {}
 _RULES["no_empty_cond_block"] = NoEmptyCondBlock
 
 class NoNestedCondBlock(Rule):
@@ -315,6 +646,26 @@ class TargetingRules(Rule):
             beneficial = all(arg in flags.BENEFICIAL_CMDS for arg in rargs)
 
         return target_self ^ beneficial
+
+    def constrain(self, last, last_args, **ctx):
+        if last is not syntax.Targeting:
+            return {}
+
+        beneficial = {
+            syntax.DoSkill: set(flags.CURATIVES) | flags.BUFFS,
+            syntax.ChooseSpell: set(flags.CURATIVES) | flags.BUFFS,
+            syntax.ThrowUseItem: flags.BENEFICIAL_ITEMS,
+            syntax.UseCommand: flags.BENEFICIAL_CMDS,
+        }
+        if len(last_args) >= 1 and last_args[0] in flags.SELF_TARGETS:
+            # Only beneficial actions, with nothing but beneficial arguments
+            allowed = dict.fromkeys(syntax.Cmd._CMD_REG)
+            allowed.update({cmd._BYTEVAL: set(args) for cmd, args in beneficial.items()})
+            return allowed
+
+        # Anything else must not be (entirely) beneficial, which only maps to a per argument
+        # restriction for a single argument
+        return {syntax.DoSkill._BYTEVAL: self.ALL_SKILLS - beneficial[syntax.DoSkill]}
 _RULES["targeting_rules"] = TargetingRules
 
 class EventRules(Rule):
@@ -335,6 +686,12 @@ class EventRules(Rule):
         return not (ctx["phase"] == "main" and lhs is syntax.CmdPred
                     and len(largs > 0)
                     and largs == syntax.AlterFormation._DIE_LIKE_A_BOSS)
+
+    def constrain(self, last, last_args, **ctx):
+        # Outside of the main phase, this is never allowed
+        if list(last_args) == syntax.CmdPred._IF_SELF_DEAD and ctx["phase"] != "main":
+            return {syntax.AlterFormation._BYTEVAL: None}
+        return {}
 _RULES["event_rules"] = EventRules
 
 class BanSkill(Rule):
@@ -0,0 +1,54 @@
+class SpoilerMeta:
+    """
+    How the scripts were generated, for the spoiler. Whatever the scripts of an area share (the pool of
+    scripts they were made from, the difficulty and the command graph) is kept once per area, and the
+    record of every script only points to its area. The spoiler then lists the areas once, up front.
+
+    >>> meta = SpoilerMeta()
+    >>> meta.add_area("area 0", {"Guard", "Leafer"}, 0.0, "<graph>")
+    >>> meta.add_script("Leafer", "from graph", "area 0")
+    >>> print(meta.render("Leafer"))
+    type: from graph
+    created from: area 0 (see top)
+    """
+    def __init__(self):
+        self.areas = {}
+        self.scripts = {}
+
+    def __contains__(self, name):
+        return name in self.scripts
+
+    def add_area(self, key, pool, difficulty, graph):
+        """
+        :param key: `str` label of the area in the spoiler
+        :param pool: names of the scripts the graph was made from, copied as it may change afterwards
+        :param difficulty: difficulty rating of the area
+        :param graph: rendering of the command graph, `str` or `Deferred` to only render it when written
+        """
+        self.areas[key] = {"pool": sorted(map(str, pool)), "difficulty": difficulty, "graph": graph}
+
+    def add_script(self, name, kind, area):
+        """
+        :param kind: `str` how the script was made, e.g. "from template"
+        :param area: key of the area it belongs to, see `add_area`
+        """
+        self.scripts[name] = {"type": kind, "area": area}
+
+    def render_areas(self):
+        """
+        The shared sections, each area once.
+        """
+        sections = []
+        for key, area in self.areas.items():
+            sections.append(f"--- {key} ---\n"
+                            f"created from: {', '.join(area['pool'])}\n"
+                            f"difficulty rating: {area['difficulty']}\n"
+                            f"command graph:{area['graph']}\n")
+        return "\n".join(sections)
+
+    def render(self, name):
+        """
+        The record of a script, pointing to its area.
+        """
+        script = self.scripts[name]
+        return f"type: {script['type']}\ncreated from: {script['area']} (see top)"
@@ -50,7 +50,7 @@ def apply_syntax_rules(gptr, weights):
     # 0xF1 must be followed by something valid (an attack)
     if gptr == Targeting._BYTEVAL:
         for cmd in weights:
-            if cmd not in set(c._BYTEVAL for c in Targeting.VALID_TARGETABLE):
+            if cmd not in _TARGETABLE:
                 weights[cmd] = 0
 
     # This technically changes the graph, but might be unavoidable
@@ -113,23 +113,25 @@ class Cmd:
         """
         Expand the command into its randomized parameters with argument graph `arg_g`.
 
-        :param arg_g: `networkx.DiGraph` a graph containing the relationships between the parameters; must include the command byte as well
+        :param arg_g: `networkx.DiGraph` a graph containing the relationships between the parameters; must include the command byte as well.
+            Can also be an already compiled `command_graph.ArgGraphSampler`. Edge weights are respected.
         :param virtual: `bool` Command is not actually in syntax, so do not prepend it to result
         :return: a `list` of byte values corresponding to the command parameters
         """
+        from .command_graph import ArgGraphSampler
+        sampler = arg_g if isinstance(arg_g, ArgGraphSampler) else ArgGraphSampler(arg_g)
+
         # We may not need the syntax marker
         stack = [] if virtual else [cls._BYTEVAL]
 
-        gptr = arg_g[cls._BYTEVAL]
+        gptr = cls._BYTEVAL
         while len(stack) < (cls._NARGS or 0):
             try:
-                gptr = numpy.random.choice(list(gptr))
+                gptr = sampler.choice(gptr)
                 stack.append(gptr)
-            except ValueError:
+            except IndexError:
                 gptr = cls._BYTEVAL
 
-            gptr = arg_g[gptr]
-
         return stack
 
     def __init__(self, *args):
@@ -319,6 +321,9 @@ class Targeting(Cmd, byteval=0xF1, nargs=1, descr="TARGETTING",
     def validate_args(cls, *args, left=None):
         return set(args).issubset(cls._ALLOWED_ARGS)
 
+# Byte values of the above, for apply_syntax_rules
+_TARGETABLE = frozenset(c._BYTEVAL for c in Targeting.VALID_TARGETABLE)
+
 class SpecialEvent(Cmd, byteval=0xF7, nargs=1, descr="SPECIAL EVENT",
                         # FIXME: need event list
                         allowed_args=set(flags.SPECIAL_EVENTS)):
@@ -526,4 +531,7 @@ class EndBlock(Cmd, byteval=0xFF, nargs=0, descr="END BLOCK"):
     """
     pass
 
-ATTACK_CMDS = {ChooseSpell, ThrowUseItem, UseCommand, DoSkill}
\ No newline at end of file
+ATTACK_CMDS = {ChooseSpell, ThrowUseItem, UseCommand, DoSkill}
+
+# Number of bytes taken up by a token beginning with this byte value, skills are a single byte
+TOKEN_WIDTH = [1 + (Cmd._CMD_REG[b]._NARGS or 0) if b in Cmd._CMD_REG else 1 for b in range(0x100)]
@@ -0,0 +1,54 @@
+import json
+import time
+import contextlib
+from collections import defaultdict
+
+class PhaseTimer:
+    """
+    Wall time spent in the phases of a run. Every timed phase is kept as a record, along with the
+    tags of the timer (e.g. the seed) and the keys it was timed with (e.g. the area).
+
+    >>> timer = PhaseTimer(seed=0)
+    >>> with timer("area_graph", set_idx=1):
+    ...     pass
+    >>> [(r["seed"], r["phase"], r["set_idx"]) for r in timer.records]
+    [(0, 'area_graph', 1)]
+    """
+    def __init__(self, **tags):
+        self.tags = tags
+        self.records = []
+
+    @contextlib.contextmanager
+    def __call__(self, phase, **keys):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append({**self.tags, "phase": phase, **keys,
+                                 "seconds": time.perf_counter() - start})
+
+    def write(self, path):
+        """
+        Write the records as JSON lines, one record per line.
+        """
+        with open(path, "w") as fout:
+            for record in self.records:
+                print(json.dumps(record), file=fout)
+
+def summarize(records):
+    """
+    Table of the total, mean and max time of every phase over `records`, in order of first appearance.
+
+    :param records: `list` of records, see `PhaseTimer.records`
+    :return: `str` table
+    """
+    times = defaultdict(list)
+    for record in records:
+        times[record["phase"]].append(record["seconds"])
+    total = sum(map(sum, times.values())) or 1
+
+    lines = [f"{'phase':<20} {'count':>6} {'total (s)':>10} {'mean (s)':>10} {'max (s)':>10} {'share':>7}"]
+    for phase, t in times.items():
+        lines.append(f"{phase:<20} {len(t):>6} {sum(t):>10.3f} {sum(t) / len(t):>10.4f} {max(t):>10.4f} "
+                     f"{sum(t) / total:>7.1%}")
+    return "\n".join(lines)
@@ -0,0 +1,70 @@
+import os
+import time
+import argparse
+
+import logging
+logging.basicConfig()
+
+import numpy
+
+from ai_scribe import extract
+from ai_scribe import command_graph
+
+log = logging.getLogger("ai_scribe")
+
+argp = argparse.ArgumentParser(description="Measure how fast command tokens can be sampled from a command graph.")
+
+argp.add_argument("-p", "--path-to-rom",
+                  help="(required) Path to ROM file to build the command graph from.")
+argp.add_argument("-n", "--num-tokens", type=int, default=100000,
+                  help="Number of tokens to draw with each method, default is 100000.")
+
+def _walk(sample, ntokens):
+    """
+    Draw `ntokens` tokens, following the chain of commands from the start marker.
+    """
+    gptr = "^"
+    start = time.perf_counter()
+    for _ in range(ntokens):
+        gptr = sample(gptr)
+    return ntokens / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    args = argp.parse_args()
+
+    src = args.path_to_rom
+    if src is None:
+        exit("Specify path to ROM with '-p'")
+    if not os.path.exists(src):
+        exit(f"Path {src} does not exist.")
+
+    scripts = extract.extract(src)
+    cmd_graph = command_graph.RestrictedCommandGraph(backend="dense")
+    cmd_graph.from_scripts(scripts)
+
+    # The graph as it is during generation, so every node has somewhere to go
+    tmat = cmd_graph.transitions.for_generation(disallow_commands={0xF7, 0xF2})
+    g = tmat.graph
+
+    numpy.random.seed(0)
+    command_graph.RNG_POOL.seed(0)
+
+    # Original method: per token weight dict, syntax rules and numpy.random.choice
+    def nx_sample(gptr):
+        return cmd_graph.generate_script_token(g, gptr)
+
+    # Pre-normalized cumulative rows and a binary search
+    cdf = tmat.cdf()
+    def cdf_sample(gptr):
+        row = cdf[command_graph._OPCODE_POS[gptr]]
+        return command_graph.OPCODE_INDEX[row.searchsorted(numpy.random.random_sample(), side="right")]
+
+    # Alias tables and pooled random numbers
+    def alias_sample(gptr):
+        return tmat.sample(gptr)
+
+    print(f"{'method':<24} tokens / s")
+    for name, sample in [("networkx + choice", nx_sample),
+                         ("cdf + searchsorted", cdf_sample),
+                         ("alias + pool", alias_sample)]:
+        print(f"{name:<24} {_walk(sample, args.num_tokens):,.0f}")
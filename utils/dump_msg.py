@@ -120,9 +120,7 @@ if __name__ == "__main__":
         exit(f"Path {src} does not exist.")
 
     log.info(f"Reading {src}")
-    with open(src, "rb") as fin:
-        romfile = fin.read()
-    batt_msgs = extract.extract_battle_msgs(romfile)
+    batt_msgs = extract.extract_battle_msgs(src)
 
     for i, msg in batt_msgs.items():
         if len(msg) == 0 and not args.no_suppress_empty:
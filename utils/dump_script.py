@@ -11,6 +11,7 @@ log = logging.getLogger("ai_scribe")
 from ai_scribe import _NAME_ALIASES
 from ai_scribe import extract
 from ai_scribe import flags
+from ai_scribe.rom import RomImage
 
 argp = argparse.ArgumentParser()
 
@@ -44,60 +45,64 @@ if __name__ == "__main__":
         exit(f"Path {src} does not exist.")
 
     log.info(f"Reading {src}")
-    scripts, names, blks = extract.extract(src, return_names=True)
+    # Map once, all of the extraction calls below share this
+    rom = RomImage(src)
+    scripts, names, blks = extract.extract(rom, return_names=True)
     log.info(f"Found {len(scripts)} scripts")
 
     if args.verify_scripts:
         log.info(f"Verifying {src}")
+        # Index once, all of the checks below are lookups into it
+        index = extract.OpcodeIndex(scripts)
+
         print("--- SPECIAL ANIMATIONS ---")
-        alts = extract.identify_special_animations(scripts)
-        # FIXME: there can be more than one
-        for sid, (anim, targ, unkn) in alts.items():
+        alts = extract.identify_special_animations(index)
+        for sid, uses in alts.items():
             name = names[sid]
-            anim = flags.ANIMATIONS[anim]
-            targs = [i for i in range(8) if i & (1 << i)]
-            targs = "self" if len(targs) == 0 else "{" + ", ".join(targs) + "}"
-            print(f"{name} ({sid}):\n\t{targs} {anim} with unknown byte val {unkn}")
+            for anim, targ, unkn in uses:
+                anim = flags.ANIMATIONS[anim]
+                targs = [i for i in range(8) if i & (1 << i)]
+                targs = "self" if len(targs) == 0 else "{" + ", ".join(targs) + "}"
+                print(f"{name} ({sid}):\n\t{targs} {anim} with unknown byte val {unkn}")
 
         # Check on formation alterations and changes
         print("--- FORMATION ALTERATIONS ---")
-        alts = extract.identify_formation_alterations(scripts)
-        # FIXME: there can be more than one
-        for sid, (anim, act, targ) in alts.items():
+        alts = extract.identify_formation_alterations(index)
+        FORM_ALT = {
+            0: "UNHIDE AT MAX HP",
+            1: "KILLED",
+            2: "UNHIDE AT CUR HP",
+            3: "HIDE AT MAX HP",
+            4: "HIDE AT CUR HP",
+        }
+        for sid, uses in alts.items():
             name = names[sid]
-            FORM_ALT = {
-                0: "UNHIDE AT MAX HP",
-                1: "KILLED",
-                2: "UNHIDE AT CUR HP",
-                3: "HIDE AT MAX HP",
-                4: "HIDE AT CUR HP",
-            }
-            act = FORM_ALT.get(act, "???")
-            try:
-                anim = flags.ENT_ANIMATIONS[anim]
-            except IndexError:
-                anim = f"UNKNOWN ({anim})"
-            targs = [i for i in range(8) if i & (1 << i)]
-            targs = "self" if len(targs) == 0 else "{" + ", ".join(targs) + "}"
-            print(f"{name} ({sid}):\n\t{act} {targs} with animation {anim}")
+            for anim, act, targ in uses:
+                act = FORM_ALT.get(act, "???")
+                try:
+                    anim = flags.ENT_ANIMATIONS[anim]
+                except IndexError:
+                    anim = f"UNKNOWN ({anim})"
+                targs = [i for i in range(8) if i & (1 << i)]
+                targs = "self" if len(targs) == 0 else "{" + ", ".join(targs) + "}"
+                print(f"{name} ({sid}):\n\t{act} {targs} with animation {anim}")
 
         print("--- FORMATION CHANGES ---")
-        changes = extract.identify_formation_swaps(scripts)
-        for sid, chng in changes.items():
+        changes = extract.identify_formation_swaps(index)
+        for sid, uses in changes.items():
             name = names[sid]
-            to_form = 0x100 * chng[2] + chng[1]
-            max_hp = (to_form & 0x8000) == 0x8000
-            to_form = ((to_form << 1) & 0xFFF) >> 1
-            print(f"{name} ({sid}):\n\tunknown, should be zero: {chng[0]} to form {to_form} with max hp? {max_hp}")
+            for chng in uses:
+                to_form = 0x100 * chng[2] + chng[1]
+                max_hp = (to_form & 0x8000) == 0x8000
+                to_form = ((to_form << 1) & 0xFFF) >> 1
+                print(f"{name} ({sid}):\n\tunknown, should be zero: {chng[0]} to form {to_form} with max hp? {max_hp}")
 
         # Ensure all events are present and in the correct places
-        special_events = extract.identify_special_event_scripts(scripts)
+        special_events = extract.identify_special_event_scripts(index)
         print("--- SPECIAL EVENTS ---")
         for event, sid in special_events.items():
             name = names[sid]
             print(f"{name} ({sid}): {flags.SPECIAL_EVENTS[event]} ({hex(event)})")
-        # NOTE: identify only gets one event per script, so script managers
-        # may not be fully represented here (E.g. Kefka, Vargas, etc...)
         if len(special_events) < 15:
             exit("The required number of special event bytes is not present.")
         exit()
@@ -105,9 +110,9 @@ if __name__ == "__main__":
     # Print only the names with their lookup order and metadata
     if args.list_names:
         # Internal aliases
-        names = extract.extract_names(src, alias_duplicates=False)
+        names = extract.extract_names(rom, alias_duplicates=False)
 
-        ptrs = extract.extract_script_ptrs(src)
+        ptrs = extract.extract_script_ptrs(rom)
 
         base = 34 if args.alias_duplicates else 12
         n_per_line = 2 if args.alias_duplicates else 3
@@ -145,7 +150,7 @@ if __name__ == "__main__":
 
     # Print only a selection of scripts
     if args.print_scripts and len(args.print_scripts) > 0:
-        names = extract.extract_names(src, alias_duplicates=False)
+        names = extract.extract_names(rom, alias_duplicates=False)
         for _name in args.print_scripts:
             name = None
             try: